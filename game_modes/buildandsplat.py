@@ -28,10 +28,10 @@ from piqueserver.commands import add, admin, get_player, name
 from pyspades import contained as loaders
 from pyspades.weapon import WEAPONS
 from twisted.internet import reactor
-from twisted.internet.task import LoopingCall
 from pyspades import world
 import math
 import random
+import time
 
 # Parameters for the Inknade
 INKNADE_RAYS = 128
@@ -49,11 +49,30 @@ HEAL_BY_FRIENDLY_FIRE = True
 
 GLOBAL_STAT_INTERVAL = 20
 
+# how often the splatgauge (progress bar) is updated, in seconds
+SPLATGAUGE_INTERVAL = 0.2
+
+# seconds of each world update the mode's periodic tasks may use together.
+# a task that would exceed it waits for the next world update.
+TICK_BUDGET = 0.004
+
 INFINIINK = True
 
+# painted colors are rounded to multiples of this (a power of two). 1 keeps
+# them exact, a larger step like 8 makes neighboring voxels share colors so
+# more of their updates can be batched, at the cost of visible banding.
+PAINT_COLOR_STEP = 1
+
+# weights of the team color when painting over a block, out of 256
+PAINT_BLEND_WEIGHTS = list(range(160, 201, 8))
+
+# longest BlockLine sent for a run of painted voxels
+MAX_PAINT_RUN = 64
+
 block_action = loaders.BlockAction()
 change_weapon = loaders.ChangeWeapon()
 set_color = loaders.SetColor()
+block_line = loaders.BlockLine()
 progress_bar = loaders.ProgressBar()
 move_object = loaders.MoveObject()
 restock = loaders.Restock()
@@ -80,6 +99,15 @@ weapon_trajectory_param = {
     }
 }
 
+face_neighbors = [
+    (-1, 0, 0),
+    (1, 0, 0),
+    (0, -1, 0),
+    (0, 1, 0),
+    (0, 0, -1),
+    (0, 0, 1)
+]
+
 drop_points_list = []
 for size in range(0, 4):
     drop_points = []
@@ -90,6 +118,39 @@ for size in range(0, 4):
                     drop_points.append((dx, dy, dz))
     drop_points_list.append(drop_points)
 
+def random_directions(count):
+    # uniformly distributed unit vectors
+    ret = []
+    while len(ret) < count:
+        x = random.gauss(0.0, 1.0)
+        y = random.gauss(0.0, 1.0)
+        z = random.gauss(0.0, 1.0)
+        length = math.sqrt(x * x + y * y + z * z)
+        if length > 0.0:
+            ret.append((x / length, y / length, z / length))
+    return ret
+
+def cast_rays(game_world, origin, directions, max_range):
+    # casts a ray from origin along every direction and returns the blocks
+    # hit within max_range. one Character is turned around for all rays
+    # instead of constructing one per ray.
+    pts = []
+    if len(directions) == 0:
+        return pts
+    ox, oy, oz = origin.x, origin.y, origin.z
+    range_sqr = max_range * max_range
+    caster = world.Character(game_world, origin, Vertex3(*directions[0]))
+    for dx, dy, dz in directions:
+        caster.set_orientation(dx, dy, dz)
+        loc = caster.cast_ray(max_range * 2.0)
+        if loc:
+            x, y, z = loc
+            if (x - ox) ** 2 + (y - oy) ** 2 + (z - oz) ** 2 > range_sqr:
+                # out of range
+                continue
+            pts.append((x, y, z))
+    return pts
+
 # fire ink when a weapon was fired
 def apply_splatgun(weapon):
     class Splatgun(weapon):
@@ -170,6 +231,169 @@ def blend_color(a, b, p):
     b = blend_color_single(b1, b2, p)
     return r, g, b
 
+def quantize_channel(c):
+    return min((c + (PAINT_COLOR_STEP >> 1)) & ~(PAINT_COLOR_STEP - 1), 255)
+
+# (team channel, weight) -> table for bytes.translate that blends a channel
+# with the team channel and quantizes the result
+blend_tables = {}
+
+def blend_table(b, p):
+    table = blend_tables.get((b, p))
+    if table is None:
+        table = bytes(quantize_channel(blend_color_single(a, b, p)) for a in range(256))
+        blend_tables[(b, p)] = table
+    return table
+
+def blend_colors(colors, team_color, weights):
+    # blend_color and quantize every color of colors with team_color, by the
+    # weight at the same index. colors of one weight are blended together,
+    # each channel with a single bytes.translate.
+    by_weight = {}
+    for i, p in enumerate(weights):
+        by_weight.setdefault(p, []).append(i)
+    blended = [None] * len(colors)
+    for p, indices in by_weight.items():
+        channels = [bytes(colors[i][c] for i in indices).translate(blend_table(team_color[c], p))
+            for c in range(3)]
+        for i, r, g, b in zip(indices, *channels):
+            blended[i] = (r, g, b)
+    return blended
+
+def splat_points(in_points, rng, solid_surface):
+    # spreads every hit into the drop points of size rng. a drop point
+    # squeezed between two surface blocks along an axis is nudged along it,
+    # solid_surface(x, y, z) tells whether a voxel is a solid surface block
+    pts = []
+    for x, y, z in in_points:
+        for dx, dy, dz in drop_points_list[rng]:
+            sx = x + dx; sy = y + dy; sz = z + dz
+            pts.append((sx, sy, sz))
+            if solid_surface(sx - 1, sy, sz) and solid_surface(sx + 1, sy, sz):
+                sx += random.randint(-1,1)
+            if solid_surface(sx, sy - 1, sz) and solid_surface(sx, sy + 1, sz):
+                sy += random.randint(-1,1)
+            if solid_surface(sx, sy, sz - 1) and solid_surface(sx, sy, sz + 1):
+                sz += random.randint(-1,1)
+            pts.append((sx, sy, sz))
+    return pts
+
+class SurfaceCache:
+    # remembers which voxels are solid surface blocks
+    #  0 -- not looked up yet
+    #  1 -- solid surface block
+    #  2 -- anything else
+    # building or removing a block only changes it and its neighbors, so
+    # those are looked up again after invalidate()
+
+    def __init__(self, mp):
+        self.map = mp
+        self.cells = bytearray(512 * 512 * 64)
+    def is_solid_surface(self, x, y, z):
+        mp = self.map
+        if x < 0 or y < 0 or z < 0 or x >= 512 or y >= 512 or z >= 64:
+            return mp.get_solid(x, y, z) and mp.is_surface(x, y, z)
+        index = x | (y << 9) | (z << 18)
+        value = self.cells[index]
+        if value == 0:
+            value = 1 if mp.get_solid(x, y, z) and mp.is_surface(x, y, z) else 2
+            self.cells[index] = value
+        return value == 1
+    def invalidate(self, x, y, z):
+        cells = self.cells
+        for dx, dy, dz in [(0, 0, 0)] + face_neighbors:
+            nx = x + dx; ny = y + dy; nz = z + dz
+            if 0 <= nx < 512 and 0 <= ny < 512 and 0 <= nz < 64:
+                cells[nx | (ny << 9) | (nz << 18)] = 0
+
+class TickTask:
+    def __init__(self, name, callback, interval, budget):
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.budget = budget
+        self.next_run = 0.0
+        self.runs = 0
+        self.skipped = 0 # runs dropped because the server fell behind
+        self.deferred = 0 # world updates it waited for the tick budget
+        self.overruns = 0 # runs that took longer than budget
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+class TickScheduler:
+    # runs the mode's periodic work from on_world_update, in place of a
+    # LoopingCall per task. tasks run every interval seconds (0 is every
+    # world update) and are expected to take at most budget seconds.
+
+    def __init__(self, tick_budget = TICK_BUDGET):
+        self.tick_budget = tick_budget
+        self.tasks = []
+    def add(self, name, callback, interval, budget):
+        task = TickTask(name, callback, interval, budget)
+        task.next_run = reactor.seconds()
+        self.tasks.append(task)
+        return task
+    def run(self, now):
+        spent = 0.0
+        # most overdue first, so deferred tasks go first next time
+        for task in sorted(self.tasks, key = lambda task: task.next_run):
+            if task.next_run > now:
+                break
+            if spent > 0.0 and spent + task.budget > self.tick_budget:
+                task.deferred += 1
+                continue
+            if task.interval > 0:
+                # a late task runs once, not once for every missed interval
+                missed = int((now - task.next_run) / task.interval)
+                task.skipped += missed
+                task.next_run += (missed + 1) * task.interval
+            else:
+                task.next_run = now
+            start = time.perf_counter()
+            try:
+                task.callback()
+            finally:
+                elapsed = time.perf_counter() - start
+                spent += elapsed
+                task.runs += 1
+                task.total_time += elapsed
+                task.max_time = max(task.max_time, elapsed)
+                if elapsed > task.budget:
+                    task.overruns += 1
+    def get_stat_messages(self):
+        msgs = []
+        for task in self.tasks:
+            msgs.append("N%% %s: %d runs, %.2f ms avg, %.2f ms max, %d over budget, %d skipped, %d deferred" % (
+                task.name, task.runs, task.total_time * 1000 / max(task.runs, 1),
+                task.max_time * 1000, task.overruns, task.skipped, task.deferred))
+        return msgs
+
+def paint_runs(mp, points):
+    # splits same colored points into runs along x that can be rebuilt with
+    # one BlockLine. the whole run is destroyed before it's rebuilt, so only
+    # voxels that nothing can hang on are joined: air above, a block below
+    # that isn't repainted too, and every block beside it resting on a block
+    # of its own.
+    batch = set(points)
+    runs = []
+    run = None
+    for x, y, z in sorted(points, key = lambda p: (p[2], p[1], p[0])):
+        joinable = not mp.get_solid(x, y, z - 1) and mp.get_solid(x, y, z + 1) and \
+            (x, y, z + 1) not in batch
+        if joinable:
+            for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+                if mp.get_solid(x + dx, y + dy, z) and not mp.get_solid(x + dx, y + dy, z + 1):
+                    joinable = False
+                    break
+        if joinable and run is not None and run[-1] == (x - 1, y, z) and len(run) < MAX_PAINT_RUN:
+            run.append((x, y, z))
+            continue
+        run = [(x, y, z)]
+        runs.append(run)
+        if not joinable:
+            run = None
+    return runs
+
 @name('stat')
 def show_stat(connection):
     protocol = connection.protocol
@@ -177,8 +401,28 @@ def show_stat(connection):
     connection.send_chat(msg)
 add(show_stat)
 
+@name('tickstat')
+@admin
+def show_tick_stat(connection):
+    protocol = connection.protocol
+    if protocol.tick_scheduler is None:
+        return
+    for msg in protocol.tick_scheduler.get_stat_messages():
+        connection.send_chat(msg)
+add(show_tick_stat)
+
+@name('paintstat')
+def show_paint_stat(connection):
+    protocol = connection.protocol
+    msg = protocol.get_paint_stat_message()
+    connection.send_chat(msg)
+add(show_paint_stat)
+
 def apply_script(protocol, connection, config):
     class BuildAndSplatConnection(connection):
+        # (x, y, z) -> painter, painted while this player loaded the map
+        paint_backlog = None
+
         def get_spawn_location(self):
             # don't want spawn location decided using territory location
             self.protocol.game_mode = CTF_MODE
@@ -202,18 +446,8 @@ def apply_script(protocol, connection, config):
                 params = weapon_trajectory_param[self.weapon_object.id]
                 weapon_range = params['range']
 
-                pts = []
-                for bullet in bullets:
-
-                    dummy_character = world.Character(self.world_object.world, self.world_object.position, bullet)
-
-                    loc = dummy_character.cast_ray(weapon_range * 2.0)
-                    if loc:
-                        x, y, z = loc
-                        if (Vertex3(x, y, z) - self.world_object.position).length_sqr() > weapon_range*weapon_range:
-                            # out of range
-                            continue
-                        pts.append((x, y, z))
+                pts = cast_rays(self.world_object.world, self.world_object.position,
+                    [bullet.get() for bullet in bullets], weapon_range)
                 self.protocol.paint_block_by_team_splat(self, pts, self.team, params['drop_size'])
 
         def on_block_build_attempt(self, x, y, z):
@@ -233,6 +467,7 @@ def apply_script(protocol, connection, config):
             return connection.on_block_build_attempt(self, x, y, z)
 
         def on_block_build(self, x, y, z):
+            self.protocol.surface_cache.invalidate(x, y, z)
 
             # check owner
             if self.team is not None:
@@ -240,16 +475,11 @@ def apply_script(protocol, connection, config):
 
             # if some blocks were completely covered by the new one, it's no longer owned
             m = self.protocol.map
-            for dx, dy, dz in [
-                (-1, 0, 0),
-                (1, 0, 0),
-                (0, -1, 0),
-                (0, 1, 0),
-                (0, 0, -1),
-                (0, 0, 1)
-            ]:
+            covered = []
+            for dx, dy, dz in face_neighbors:
                 if not m.is_surface(x+dx, y+dy, z+dz):
-                    self.protocol.territory_map.own(x+dx, y+dy, z+dz, 0)
+                    covered.append((x+dx, y+dy, z+dz))
+            self.protocol.territory_map.own_many(covered, 0)
 
             return connection.on_block_build(self, x, y, z)
 
@@ -260,13 +490,60 @@ def apply_script(protocol, connection, config):
                     return False
             elif mode == GRENADE_DESTROY:
                 return False
-            return connection.on_block_destroy(self, x, y, z, mode)
+            result = connection.on_block_destroy(self, x, y, z, mode)
+            if result != False:
+                if mode == SPADE_DESTROY:
+                    points = [(x, y, z - 1), (x, y, z), (x, y, z + 1)]
+                else:
+                    points = [(x, y, z)]
+                self.protocol.unown_falling_blocks(points)
+            return result
+
+        def on_line_build(self, points):
+            for x, y, z in points:
+                self.protocol.surface_cache.invalidate(x, y, z)
+            return connection.on_line_build(self, points)
 
         def on_block_removed(self, x, y, z):
+            self.protocol.surface_cache.invalidate(x, y, z)
             self.protocol.territory_map.own(x, y, z, 0)
 
             return connection.on_block_removed(self, x, y, z)
 
+        def on_join(self):
+            # paint that happened while the map was sent, see flush_paint
+            if self.paint_backlog:
+                players = self.protocol.players
+                # painters that left may have passed their id on already,
+                # anyone else who is in the game can stand in for them. With
+                # nobody else around the player paints with its own id and
+                # gets its color back afterwards.
+                stand_in = self
+                for player in players.values():
+                    if player is not self:
+                        stand_in = player
+                        break
+                color = self.color
+                painted = {}
+                for point, painter in self.paint_backlog.items():
+                    if players.get(painter.player_id) is not painter:
+                        painter = stand_in
+                    painted[point] = painter
+                self.protocol.send_paint(painted, self.send_contained)
+                if self.color != color:
+                    self.color = color
+                    set_color.player_id = self.player_id
+                    set_color.value = make_color(*color)
+                    self.send_contained(set_color)
+            self.paint_backlog = None
+            return connection.on_join(self)
+
+        def on_disconnect(self):
+            # the painter's id is used for the queued paint, send it while
+            # it is still valid
+            self.protocol.flush_paint()
+            return connection.on_disconnect(self)
+
         def _on_reload(self):
             if INFINIINK:
                 self.weapon_object.restock()
@@ -288,20 +565,7 @@ def apply_script(protocol, connection, config):
                         break
                     pos.z -= 1.0
 
-                pts = []
-
-                for i in range(0, INKNADE_RAYS):
-                    orient = Vertex3(random.gauss(0.0, 1.0), random.gauss(0.0, 1.0), random.gauss(0.0, 1.0))
-                    orient.normalize()
-                    dummy_character = world.Character(grenade.world, pos, orient)
-
-                    loc = dummy_character.cast_ray(INKNADE_RANGE * 2.0)
-                    if loc:
-                        x, y, z = loc
-                        if (Vertex3(x, y, z) - pos).length_sqr() > INKNADE_RANGE*INKNADE_RANGE:
-                            # out of range
-                            continue
-                        pts.append((x, y, z))
+                pts = cast_rays(grenade.world, pos, random_directions(INKNADE_RAYS), INKNADE_RANGE)
                 self.protocol.paint_block_by_team_splat(self, pts, self.team, random.randint(INKNADE_DROP_SIZE_MIN, INKNADE_DROP_SIZE_MAX))
 
             return connection.grenade_exploded(self, grenade)
@@ -310,19 +574,7 @@ def apply_script(protocol, connection, config):
             if self != hit_player and type in [WEAPON_KILL, HEADSHOT_KILL] and self.team is not None:
                 # inkdamage
                 pos = hit_player.world_object.position
-                pts = []
-                for i in range(0, INKDAMAGE_RAYS):
-                    orient = Vertex3(random.gauss(0.0, 1.0), random.gauss(0.0, 1.0), random.gauss(0.0, 1.0))
-                    orient.normalize()
-                    dummy_character = world.Character(self.world_object.world, pos, orient)
-
-                    loc = dummy_character.cast_ray(INKDAMAGE_RANGE * 2.0)
-                    if loc:
-                        x, y, z = loc
-                        if (Vertex3(x, y, z) - pos).length_sqr() > INKDAMAGE_RANGE*INKDAMAGE_RANGE:
-                            # out of range
-                            continue
-                        pts.append((x, y, z))
+                pts = cast_rays(self.world_object.world, pos, random_directions(INKDAMAGE_RAYS), INKDAMAGE_RANGE)
                 self.protocol.paint_block_by_team_splat(self, pts, self.team, random.randint(INKDAMAGE_DROP_SIZE_MIN, INKDAMAGE_DROP_SIZE_MAX))
 
                 # heal
@@ -342,32 +594,47 @@ def apply_script(protocol, connection, config):
         #  0 -- neutral
         #  1 -- team 1
         #  2 -- team 2
+        # one byte per voxel (16 MiB), indexed by _territory_map_compute_index
 
         def __init__(self):
             self.count = [0, 0, 0]
-            self.map = {}
+            self.map = bytearray(512 * 512 * 64)
             return
         def own(self, x, y, z, new_owner):
-            if new_owner < 0 or new_owner >= 4:
+            if new_owner < 0 or new_owner >= 3:
                 raise RuntimeError("bad owner")
+            if x < 0 or y < 0 or z < 0 or x >= 512 or y >= 512 or z >= 64:
+                return False
 
             index = _territory_map_compute_index(x, y, z)
-            large_index = index >> 4
-            small_index = (index & 0xf) << 1
-
-            cell = self.map.get(large_index, 0)
-
-            owner = (cell >> small_index) & 3
+            owner = self.map[index]
             if owner == new_owner:
                 return False
 
             self.count[owner] -= 1
             self.count[new_owner] += 1
-
-            cell = (cell & ~(3 << small_index)) | (new_owner << small_index)
-            self.map[large_index] = cell
+            self.map[index] = new_owner
 
             return True
+        def own_many(self, points, new_owner):
+            # same as own() for every point, returns the number of changed cells
+            if new_owner < 0 or new_owner >= 3:
+                raise RuntimeError("bad owner")
+            cells = self.map
+            indices = set(x | (y << 9) | (z << 18) for x, y, z in points
+                if 0 <= x < 512 and 0 <= y < 512 and 0 <= z < 64)
+            indices = [index for index in indices if cells[index] != new_owner]
+            if not indices:
+                return 0
+
+            old_owners = bytes(cells[index] for index in indices)
+            for owner in range(3):
+                self.count[owner] -= old_owners.count(owner)
+            self.count[new_owner] += len(indices)
+            for index in indices:
+                cells[index] = new_owner
+
+            return len(indices)
 
         def get_score(self, team):
             return self.count[team]
@@ -375,11 +642,11 @@ def apply_script(protocol, connection, config):
     class SplatgaugeTerritory(Territory):
         def __init__(self, protocol):
             Territory.__init__(self, 0, protocol, 0, 0, 0)
-            self.check_rate_loop = LoopingCall(self.update_rate)
-            self.check_rate_loop.start(0.2)
 
         def delete(self, *arg, **kw):
-            self.check_rate_loop.stop()
+            # stops the updates, see update_splat_territory
+            if self.protocol.splat_territory is self:
+                self.protocol.splat_territory = None
             return Territory.delete(self, *arg, **kw)
 
         def add_player(self, player):
@@ -432,29 +699,31 @@ def apply_script(protocol, connection, config):
 
     class BuildAndSplatProtocol(protocol):
         game_mode = TC_MODE
+        splat_territory = None
+        tick_scheduler = None
 
         def on_map_change(self, map):
             self.territory_map = TerritoryMap()
-
-            self.check_destroy_spans = set()
-            self.check_destroy_spans_list = []
-            self.check_destroy_span_index = 0
-            self.check_destroy_loop = LoopingCall(self.check_destroy)
-            self.check_destroy_loop.start(0.1)
-
+            self.surface_cache = SurfaceCache(map)
+
+            # (x, y, z) -> player, sent at the next world update
+            self.paint_queue = {}
+            self.paint_voxels = 0
+            self.paint_packets = 0
+            for player in self.connections.values():
+                player.paint_backlog = None
+
+            self.tick_scheduler = TickScheduler()
+            self.tick_scheduler.add("paint", self.flush_paint, 0, 0.002)
+            self.tick_scheduler.add("splatgauge", self.update_splat_territory,
+                SPLATGAUGE_INTERVAL, 0.001)
             if GLOBAL_STAT_INTERVAL > 0:
-                self.report_loop = LoopingCall(self.report_stat)
-                self.report_loop.start(GLOBAL_STAT_INTERVAL)
-            else:
-                self.report_loop = None
+                self.tick_scheduler.add("stat", self.report_stat, GLOBAL_STAT_INTERVAL, 0.001)
 
             protocol.on_map_change(self, map)
 
         def on_map_leave(self):
-            if self.check_destroy_loop and self.check_destroy_loop.running:
-                self.check_destroy_loop.stop()
-            if self.report_loop and self.report_loop.running:
-                self.report_loop.stop()
+            self.tick_scheduler = None
             protocol.on_map_leave(self)
 
         def _time_up(self):
@@ -470,28 +739,64 @@ def apply_script(protocol, connection, config):
                 self.on_game_end()
 
 
-        def check_destroy(self):
-            # fallen block cannot be detected by member method.
-            # we have to somehow detect them.
-            if len(self.check_destroy_spans_list) == 0:
-                # no territory
+        def unown_falling_blocks(self, points):
+            # blocks that lose their support fall without any hook being
+            # called for them, so find them before points are destroyed:
+            # remove points for a moment, ask the map which neighbors lost
+            # contact with the ground and collect the painted blocks of
+            # those chunks.
+            mp = self.map
+            removed = []
+            for x, y, z in points:
+                if 0 <= x < 512 and 0 <= y < 512 and 0 <= z < 62 and mp.get_solid(x, y, z):
+                    removed.append((x, y, z, mp.get_color(x, y, z)))
+            if len(removed) == 0:
                 return
 
-            start_idx = self.check_destroy_span_index
-            for i in range(0, 100):
-                (x, y) = self.check_destroy_spans_list[self.check_destroy_span_index]
-
-                for z in range(0, 64):
-                    if not self.map.get_solid(x, y, z):
-                        self.territory_map.own(x, y, z, 0)
-
-                self.check_destroy_span_index += 1
-
-                if self.check_destroy_span_index == len(self.check_destroy_spans_list):
-                    self.check_destroy_span_index = 0
-
-                if self.check_destroy_span_index == start_idx:
-                    break
+            cells = self.territory_map.map
+            fallen = []
+            visited = set()
+            for x, y, z, color in removed:
+                mp.remove_point(x, y, z)
+            try:
+                for x, y, z, color in removed:
+                    for dx, dy, dz in face_neighbors:
+                        start = (x + dx, y + dy, z + dz)
+                        if start in visited or not mp.get_solid(*start):
+                            continue
+                        # check_node is 0 while the block is connected to
+                        # the ground, else the size of its floating chunk
+                        if start[2] >= 62 or not mp.check_node(*start):
+                            continue
+                        visited.add(start)
+                        chunk = []
+                        grounded = False
+                        stack = [start]
+                        while stack:
+                            cx, cy, cz = stack.pop()
+                            if cz >= 62:
+                                # can't be floating after all, leave it be
+                                grounded = True
+                                break
+                            if cells[_territory_map_compute_index(cx, cy, cz)]:
+                                chunk.append((cx, cy, cz))
+                            for dx, dy, dz in face_neighbors:
+                                node = (cx + dx, cy + dy, cz + dz)
+                                if node not in visited and mp.get_solid(*node):
+                                    visited.add(node)
+                                    stack.append(node)
+                        if not grounded:
+                            fallen.extend(chunk)
+            finally:
+                for x, y, z, color in removed:
+                    mp.set_point(x, y, z, color)
+
+            self.territory_map.own_many(fallen, 0)
+            # the destroyed blocks and everything that falls
+            for x, y, z, color in removed:
+                self.surface_cache.invalidate(x, y, z)
+            for x, y, z in visited:
+                self.surface_cache.invalidate(x, y, z)
 
         def get_cp_entities(self):
             self.splat_territory = SplatgaugeTerritory(self)
@@ -521,23 +826,14 @@ def apply_script(protocol, connection, config):
         def paint_block_by_team_splat(self, player, in_points, team, rng):
             if len(in_points) == 0:
                 return
-            pts = []
-            mp = self.map
-            for x, y, z in in_points:
-                for dx, dy, dz in drop_points_list[rng]:
-                    sx = x + dx; sy = y + dy; sz = z + dz
-                    pts.append((sx, sy, sz))
-                    if mp.get_solid(sx - 1, sy, sz) and mp.get_solid(sx + 1, sy, sz) and mp.is_surface(sx - 1, sy, sz) and mp.is_surface(sx + 1, sy, sz):
-                        sx += random.randint(-1,1)
-                    if mp.get_solid(sx, sy - 1, sz) and mp.get_solid(sx, sy + 1, sz) and mp.is_surface(sx, sy - 1, sz) and mp.is_surface(sx, sy + 1, sz):
-                        sy += random.randint(-1,1)
-                    if mp.get_solid(sx, sy, sz - 1) and mp.get_solid(sx, sy, sz + 1) and mp.is_surface(sx, sy, sz - 1) and mp.is_surface(sx, sy, sz + 1):
-                        sz += random.randint(-1,1)
-                    pts.append((sx, sy, sz))
+            pts = splat_points(in_points, rng, self.surface_cache.is_solid_surface)
             self.paint_block_by_team(player, pts, team)
 
         def paint_block_by_team(self, player, points, team):
             updated_points = set()
+            # a point listed n times is blended n times, in n rounds
+            rounds = []
+            hits = {}
             for x, y, z in points:
                 if x < 0 or y < 0 or z < 0 or x >= 512 or y >= 512 or z >= 63:
                     continue
@@ -546,38 +842,100 @@ def apply_script(protocol, connection, config):
                 if not self.map.get_solid(x, y, z) or not self.map.is_surface(x, y, z):
                     continue
 
-                # already owned?
-                if not self.territory_map.own(x, y, z, team.id + 1):
-                    pass # return False
-
                 updated_points.add((x, y, z))
 
-                color = self.map.get_color(x, y, z)
-
-                color = blend_color(color, team.color, random.randint(160,200))
+                count = hits.get((x, y, z), 0)
+                hits[(x, y, z)] = count + 1
+                if count == len(rounds):
+                    rounds.append([])
+                rounds[count].append((x, y, z))
 
-                self.map.set_point(x, y, z, color)
-
-            for x, y, z in updated_points:
+            mp = self.map
+            for round_points in rounds:
+                colors = [mp.get_color(x, y, z) for x, y, z in round_points]
+                weights = [random.choice(PAINT_BLEND_WEIGHTS) for i in range(len(round_points))]
+                colors = blend_colors(colors, team.color, weights)
+                for (x, y, z), color in zip(round_points, colors):
+                    mp.set_point(x, y, z, color)
+
+            # already owned ones are repainted all the same
+            self.territory_map.own_many(updated_points, team.id + 1)
+
+            for point in updated_points:
+                self.paint_queue[point] = player
+            self.paint_voxels += len(updated_points)
+
+        def on_world_update(self):
+            if self.tick_scheduler is not None:
+                self.tick_scheduler.run(reactor.seconds())
+            protocol.on_world_update(self)
+
+        def update_splat_territory(self):
+            if self.splat_territory is not None:
+                self.splat_territory.update_rate()
+
+        def flush_paint(self):
+            # send what was painted since the last world update: one SetColor
+            # per painter and color, voxels painted several times only once
+            if len(self.paint_queue) == 0:
+                return
+            queue = self.paint_queue
+            self.paint_queue = {}
+
+            # players still loading the map get the final colors once they
+            # joined instead of every paint packet saved for them meanwhile
+            for player in self.connections.values():
+                if player.saved_loaders is not None:
+                    if player.paint_backlog is None:
+                        player.paint_backlog = {}
+                    player.paint_backlog.update(queue)
+
+            self.paint_packets += self.send_paint(queue, self.send_contained)
+
+        def send_paint(self, painted, send_contained):
+            # painted maps (x, y, z) to the painter, returns the number of
+            # packets passed to send_contained
+            groups = {}
+            for (x, y, z), player in painted.items():
+                if not self.map.get_solid(x, y, z):
+                    # destroyed since, rebuilding it would be wrong
+                    continue
                 color = self.map.get_color(x, y, z)
+                groups.setdefault((player, color), []).append((x, y, z))
 
+            packets = 0
+            for (player, color), points in groups.items():
                 player.color = color
                 set_color.player_id = player.player_id
                 set_color.value = make_color(*color)
-                self.send_contained(set_color, sender=None, save=True)
+                send_contained(set_color)
+                packets += 1
 
-                block_action.x = x
-                block_action.y = y
-                block_action.z = z
                 block_action.player_id = player.player_id
-                block_action.value = DESTROY_BLOCK
-                self.send_contained(block_action, save = True)
-                block_action.value = BUILD_BLOCK
-                self.send_contained(block_action, save = True)
-
-                if (x, y) not in self.check_destroy_spans:
-                    self.check_destroy_spans.add((x, y))
-                    self.check_destroy_spans_list.append((x, y))
-
+                for run in paint_runs(self.map, points):
+                    for x, y, z in run:
+                        block_action.x = x
+                        block_action.y = y
+                        block_action.z = z
+                        block_action.value = DESTROY_BLOCK
+                        send_contained(block_action)
+                    if len(run) == 1:
+                        block_action.value = BUILD_BLOCK
+                        send_contained(block_action)
+                    else:
+                        block_line.player_id = player.player_id
+                        block_line.x1, block_line.y1, block_line.z1 = run[0]
+                        block_line.x2, block_line.y2, block_line.z2 = run[-1]
+                        send_contained(block_line)
+                    packets += len(run) + 1
+            return packets
+
+        def get_paint_stat_message(self):
+            # painting used to send SetColor, DESTROY_BLOCK and BUILD_BLOCK per voxel
+            unbatched = self.paint_voxels * 3
+            saved = unbatched - self.paint_packets
+            return "N%% painted %d voxels with %d packets, %d saved (%d%%)" % (
+                self.paint_voxels, self.paint_packets, saved,
+                100 * saved // max(unbatched, 1))
 
     return BuildAndSplatProtocol, BuildAndSplatConnection
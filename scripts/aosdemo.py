@@ -0,0 +1,754 @@
+"""
+Demo file handling shared by record.py and playback.py.
+
+Version 1 files are a 'BB' header (file version, AoS protocol version)
+followed by frames: a 'fH' header (seconds since connect, packet size)
+and the raw packet.
+
+Version 2 files add a flags byte to the header and a trailing index:
+
+	header     'BBB'         file version, AoS protocol version, flags
+	frames     'fH' + data   same as version 1, or compressed chunks of them
+	snapshots  ('H' + data)* latched state packets, one blob per keyframe
+	keyframes  KEYFRAME_FMT  one entry per keyframe, sorted by time
+	footer     FOOTER_FMT    magic, end of frames, keyframe table offset, count
+
+A keyframe marks a frame offset where playback can resume. Its snapshot
+holds the packets needed to bring a client that skipped ahead up to date
+(players, teams, weapons, objects), and map_offset points at the MapStart
+frame of the map that was loaded at that time. If the recorder died before
+writing the index, readers rebuild it with a single pass over the frames.
+
+With FLAG_ZLIB or FLAG_LZMA set, frames are stored in chunks of about
+CHUNK_SIZE bytes, each a CHUNK_FMT header (compressed size, raw size)
+followed by the compressed frames.
+
+Version 3 files are laid out like version 2, but a 32 bit float of seconds
+runs out of precision within hours, so frames are two varints (LEB128)
+followed by the packet: the time in microseconds shifted left by one, and
+the packet size. If the low bit of the time is set it is absolute,
+otherwise it counts from the previous frame. The first frame, every
+keyframe, every MapStart and every compressed chunk start with an absolute
+time, so reading can start at any of them. frames() started anywhere else
+yields times relative to the frame before it.
+
+Recorders write through a BufferedSink, which batches frames in memory and
+leaves the disk writes to a background thread. SegmentRecorder can start a
+new file for every map and keep a manifest of them.
+"""
+
+import json
+import mmap
+import os
+import queue
+import struct
+import threading
+import zlib
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+from time import monotonic
+try:
+	import lzma
+except ImportError: # python built without liblzma
+	lzma = None
+
+FILE_VERSION = 3
+SUPPORTED_VERSIONS = (1, 2, 3)
+
+V1_HEADER_FMT = 'BB'
+HEADER_FMT = 'BBB'
+FRAME_FMT = 'fH'
+FRAME_SIZE = struct.calcsize(FRAME_FMT)
+KEYFRAME_FMT = '<dQQQI'
+KEYFRAME_SIZE = struct.calcsize(KEYFRAME_FMT)
+FOOTER_FMT = '<4sQQI'
+FOOTER_SIZE = struct.calcsize(FOOTER_FMT)
+FOOTER_MAGIC = b'AOSK'
+CHUNK_FMT = '<II'
+CHUNK_HEADER_SIZE = struct.calcsize(CHUNK_FMT)
+CHUNK_SIZE = 64 * 1024
+CHUNK_POSITION_BITS = 24
+CHUNK_POSITION_MASK = (1 << CHUNK_POSITION_BITS) - 1
+CHUNK_CACHE_SIZE = 32
+
+FLAG_ZLIB = 1
+FLAG_LZMA = 2
+COMPRESSION_FLAGS = {'zlib': FLAG_ZLIB}
+CODECS = {FLAG_ZLIB: (zlib.compress, zlib.decompress)}
+if lzma is not None:
+	COMPRESSION_FLAGS['lzma'] = FLAG_LZMA
+	CODECS[FLAG_LZMA] = (lzma.compress, lzma.decompress)
+
+DEFAULT_PORT = 32887
+KEYFRAME_INTERVAL = 10.0 # seconds
+
+FLUSH_SIZE = 256 * 1024 # bytes
+FLUSH_INTERVAL = 2.0 # seconds
+MAX_PENDING_FLUSHES = 64
+
+# packet ids
+POSITION_DATA = 0
+ORIENTATION_DATA = 1
+WORLD_UPDATE = 2
+INPUT_DATA = 3
+WEAPON_INPUT = 4
+HIT_PACKET = 5
+GRENADE_PACKET = 6
+SET_TOOL = 7
+SET_COLOR = 8
+EXISTING_PLAYER = 9
+MOVE_OBJECT = 11
+CREATE_PLAYER = 12
+BLOCK_ACTION = 13
+BLOCK_LINE = 14
+STATE_DATA = 15
+KILL_ACTION = 16
+CHAT_MESSAGE = 17
+MAP_START = 18
+MAP_CHUNK = 19
+PLAYER_LEFT = 20
+TERRITORY_CAPTURE = 21
+PROGRESS_BAR = 22
+INTEL_CAPTURE = 23
+INTEL_PICKUP = 24
+INTEL_DROP = 25
+RESTOCK = 26
+FOG_COLOR = 27
+WEAPON_RELOAD = 28
+CHANGE_TEAM = 29
+CHANGE_WEAPON = 30
+
+# packets that only matter through their latest value, in the order they
+# have to be replayed in (players must exist before they are changed)
+LATCH_ORDER = (CREATE_PLAYER, CHANGE_TEAM, CHANGE_WEAPON, SET_TOOL,
+	SET_COLOR, KILL_ACTION, MOVE_OBJECT, TERRITORY_CAPTURE, PROGRESS_BAR,
+	FOG_COLOR)
+PLAYER_LATCHED = (CREATE_PLAYER, CHANGE_TEAM, CHANGE_WEAPON, SET_TOOL,
+	SET_COLOR, KILL_ACTION)
+OBJECT_LATCHED = (MOVE_OBJECT, TERRITORY_CAPTURE, PROGRESS_BAR)
+
+# packets a client needs to keep its copy of the map consistent
+# when the packets in between are skipped
+CATCH_UP_PACKETS = (SET_COLOR, BLOCK_ACTION, BLOCK_LINE, STATE_DATA,
+	MAP_START, MAP_CHUNK)
+
+Keyframe = namedtuple('Keyframe',
+	'time offset map_offset snapshot_offset snapshot_size')
+
+class DemoError(Exception):
+	pass
+
+class StateLatch(object):
+	"""Keeps the latest value of every latched packet for the current map"""
+	def __init__(self):
+		self.packets = {}
+	def reset(self):
+		self.packets.clear()
+	def feed(self, data):
+		packet_id = data[0]
+		if packet_id == MAP_START:
+			self.reset()
+		if len(data) < 2:
+			return
+		if packet_id == PLAYER_LEFT:
+			for key in [key for key in self.packets
+					if key[0] in PLAYER_LATCHED and key[1] == data[1]]:
+				del self.packets[key]
+		elif packet_id in (EXISTING_PLAYER, CREATE_PLAYER):
+			self.packets[(CREATE_PLAYER, data[1])] = data
+			self.packets.pop((KILL_ACTION, data[1]), None)
+		elif packet_id in PLAYER_LATCHED or packet_id in OBJECT_LATCHED:
+			self.packets[(packet_id, data[1])] = data
+		elif packet_id == FOG_COLOR:
+			self.packets[(packet_id, 0)] = data
+	def snapshot(self):
+		keys = sorted(self.packets,
+			key=lambda key: (LATCH_ORDER.index(key[0]), key[1]))
+		return [self.packets[key] for key in keys]
+
+def parse_address(address, port=-1):
+	"""Returns (ip, port) for 'host', 'host:port' and 'aos://' addresses"""
+	do_aos_conversion = address.startswith("aos://")
+	if do_aos_conversion:
+		address = address[6:]
+	if port == -1:
+		try:
+			ip, port = address.rsplit(':', 1)
+			port = int(port)
+			address = ip
+		except ValueError:
+			port = DEFAULT_PORT
+	if do_aos_conversion:
+		try:
+			dec = int(address)
+		except ValueError:
+			raise DemoError("AoS address not valid")
+		ip = ""
+		for _ in range(4):
+			ip += str(dec % 256) + "."
+			dec //= 256
+		if dec != 0:
+			raise DemoError("AoS address not valid")
+		address = ip[:-1]
+	return address, port
+
+def pack_varint(value):
+	out = bytearray()
+	while value > 0x7f:
+		out.append(value & 0x7f | 0x80)
+		value >>= 7
+	out.append(value)
+	return out
+
+def unpack_varint(buf, pos):
+	"""Returns the varint at pos and the position after it"""
+	result = shift = 0
+	while True:
+		byte = buf[pos]
+		pos += 1
+		result |= (byte & 0x7f) << shift
+		if byte < 0x80:
+			return result, pos
+		shift += 7
+
+def iter_frames(buf, pos, end, file_version):
+	"""Yields (offset, timestamp, data) for the frames in buf[pos:end],
+	data being a slice of buf. Stops at a truncated frame."""
+	if file_version < 3:
+		unpack_from = struct.Struct(FRAME_FMT).unpack_from
+		while pos + FRAME_SIZE <= end:
+			timestamp, size = unpack_from(buf, pos)
+			start = pos + FRAME_SIZE
+			if start + size > end:
+				return
+			yield pos, timestamp, buf[start:start + size]
+			pos = start + size
+		return
+	micros = 0
+	while pos < end:
+		# most frames are a few ms apart and shorter than 128 bytes,
+		# so both varints usually are a single byte
+		value = buf[pos]
+		if value < 0x80:
+			start = pos + 1
+		else:
+			try:
+				value, start = unpack_varint(buf, pos)
+			except IndexError:
+				return
+		if start >= end:
+			return
+		size = buf[start]
+		if size < 0x80:
+			start += 1
+		else:
+			try:
+				size, start = unpack_varint(buf, start)
+			except IndexError:
+				return
+		if start + size > end:
+			return
+		if value & 1:
+			micros = value >> 1
+		else:
+			micros += value >> 1
+		yield pos, micros / 1e6, buf[start:start + size]
+		pos = start + size
+
+def pack_snapshot(packets):
+	return b''.join(struct.pack('<H', len(data)) + data for data in packets)
+
+def unpack_snapshot(blob):
+	packets = []
+	pos = 0
+	while pos < len(blob):
+		size, = struct.unpack_from('<H', blob, pos)
+		pos += 2
+		packets.append(blob[pos:pos + size])
+		pos += size
+	return packets
+
+class BufferedSink(object):
+	"""File-like object that collects writes in memory and hands them to a
+	writer thread in large chunks, so a slow disk never stalls the network
+	loop. Chunks are flushed once flush_size bytes are buffered, when poll()
+	notices flush_interval has passed, and on close(). At most max_pending
+	chunks wait for the disk before write() blocks."""
+	def __init__(self, fh, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL,
+			max_pending=MAX_PENDING_FLUSHES):
+		self.fh = fh
+		self.flush_size = flush_size
+		self.flush_interval = flush_interval
+		self.buffer = bytearray()
+		self.pending = queue.Queue(max_pending)
+		self.last_flush = monotonic()
+		self.error = None
+		self.flushes = 0
+		self.flushed_bytes = 0
+		self.total_latency = 0.0
+		self.max_latency = 0.0
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+	def write(self, data):
+		self.buffer += data
+		if len(self.buffer) >= self.flush_size:
+			self.flush()
+	def poll(self):
+		if self.buffer and monotonic() - self.last_flush >= self.flush_interval:
+			self.flush()
+	def flush(self):
+		if self.error is not None:
+			raise self.error
+		if self.buffer:
+			self.pending.put(bytes(self.buffer))
+			del self.buffer[:]
+		self.last_flush = monotonic()
+	def close(self):
+		self.flush()
+		self.pending.put(None)
+		self.thread.join()
+		if self.error is not None:
+			raise self.error
+	def run(self):
+		while True:
+			chunk = self.pending.get()
+			if chunk is None:
+				return
+			if self.error is not None:
+				continue # keep draining so writers don't block forever
+			start = monotonic()
+			try:
+				self.fh.write(chunk)
+				self.fh.flush()
+			except (IOError, OSError) as err:
+				self.error = err
+				continue
+			latency = monotonic() - start
+			self.flushes += 1
+			self.flushed_bytes += len(chunk)
+			self.total_latency += latency
+			self.max_latency = max(self.max_latency, latency)
+	def stats(self):
+		if self.flushes == 0:
+			return "no data flushed"
+		return "%d bytes in %d flushes, flush latency avg %.1f ms, max %.1f ms" % (
+			self.flushed_bytes, self.flushes,
+			self.total_latency / self.flushes * 1000, self.max_latency * 1000)
+
+class IndexBuilder(object):
+	"""Decides where keyframes go and collects their snapshots"""
+	def __init__(self, keyframe_interval=KEYFRAME_INTERVAL):
+		self.keyframe_interval = keyframe_interval
+		self.latch = StateLatch()
+		self.keyframes = []
+		self.snapshots = []
+		self.map_offset = None
+		self.map_loaded = False
+		self.keyframe_due = False
+		self.last_keyframe = 0.0
+	def start_map(self, position):
+		self.map_offset = position
+		self.map_loaded = False
+	def is_due(self, timestamp):
+		return self.map_loaded and (self.keyframe_due or
+			timestamp - self.last_keyframe >= self.keyframe_interval)
+	def add_keyframe(self, timestamp, position):
+		self.keyframes.append(Keyframe(timestamp, position, self.map_offset,
+			None, None))
+		self.snapshots.append(pack_snapshot(self.latch.snapshot()))
+		self.last_keyframe = timestamp
+		self.keyframe_due = False
+	def feed(self, data):
+		self.latch.feed(data)
+		if data[0] == STATE_DATA and self.map_offset is not None:
+			self.map_loaded = True
+			self.keyframe_due = True
+
+class DemoWriter(object):
+	"""Writes frames and tracks keyframes, call close() to write the index.
+
+	compression is None, 'zlib' or 'lzma'. Compressed frames are grouped
+	into chunks that are cut at every keyframe and map start, so every
+	position stored in the index is the start of a chunk."""
+	def __init__(self, fh, aos_version, compression=None,
+			keyframe_interval=KEYFRAME_INTERVAL):
+		self.fh = fh
+		self.index = IndexBuilder(keyframe_interval)
+		if compression is None:
+			self.flags = 0
+			self.compress = None
+		else:
+			try:
+				self.flags = COMPRESSION_FLAGS[compression]
+			except KeyError:
+				raise DemoError("unsupported compression %s" % compression)
+			self.compress = CODECS[self.flags][0]
+		self.chunk = bytearray()
+		self.micros = None # time of the last frame, None after a cut
+		header = struct.pack(HEADER_FMT, FILE_VERSION, aos_version, self.flags)
+		fh.write(header)
+		self.offset = len(header)
+	def position(self):
+		if self.compress is None:
+			return self.offset
+		return (self.offset << CHUNK_POSITION_BITS) | len(self.chunk)
+	def cut(self):
+		"""Ends the current compressed chunk, the next frame gets an
+		absolute time"""
+		self.micros = None
+		if not self.chunk:
+			return
+		data = self.compress(bytes(self.chunk))
+		self.fh.write(struct.pack(CHUNK_FMT, len(data), len(self.chunk)))
+		self.fh.write(data)
+		self.offset += CHUNK_HEADER_SIZE + len(data)
+		del self.chunk[:]
+	def write(self, timestamp, data):
+		if data[0] == MAP_START:
+			self.cut()
+			self.index.start_map(self.position())
+		elif self.index.is_due(timestamp):
+			self.cut()
+			self.index.add_keyframe(timestamp, self.position())
+		# deltas between rounded times, so rounding errors don't add up
+		micros = max(0, int(round(timestamp * 1000000)))
+		if self.micros is None or micros < self.micros:
+			frame = pack_varint(micros << 1 | 1)
+		else:
+			frame = pack_varint((micros - self.micros) << 1)
+		self.micros = micros
+		frame += pack_varint(len(data))
+		if self.compress is None:
+			self.fh.write(frame)
+			self.fh.write(data)
+			self.offset += len(frame) + len(data)
+		else:
+			self.chunk += frame
+			self.chunk += data
+			if len(self.chunk) >= CHUNK_SIZE:
+				self.cut()
+		self.index.feed(data)
+	def close(self):
+		self.cut()
+		frames_end = self.offset
+		entries = []
+		for keyframe, blob in zip(self.index.keyframes, self.index.snapshots):
+			entries.append(struct.pack(KEYFRAME_FMT, keyframe.time,
+				keyframe.offset, keyframe.map_offset, self.offset, len(blob)))
+			self.fh.write(blob)
+			self.offset += len(blob)
+		table_offset = self.offset
+		self.fh.write(b''.join(entries))
+		self.fh.write(struct.pack(FOOTER_FMT, FOOTER_MAGIC, frames_end,
+			table_offset, len(entries)))
+
+class DemoReader(object):
+	"""Random access to a demo file through its keyframe index.
+
+	The file is memory mapped, so any number of frames() cursors can walk
+	it at once and reading a packet is a slice of the shared mapping.
+	Decompressed chunks are shared between cursors through a small cache.
+
+	Frames are addressed by position: the byte offset of the frame, or for
+	compressed files the chunk offset shifted left by CHUNK_POSITION_BITS
+	plus the frame's offset inside the decompressed chunk."""
+	def __init__(self, path, rebuild=True):
+		with open(path, 'rb') as fh:
+			try:
+				self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+			except ValueError: # empty file
+				raise DemoError("not a demo file")
+		mm = self.mm
+		if len(mm) < 2:
+			raise DemoError("not a demo file")
+		self.file_version, self.aos_version = struct.unpack_from(
+			V1_HEADER_FMT, mm)
+		if self.file_version not in SUPPORTED_VERSIONS:
+			raise DemoError("unsupported demo version %d" % self.file_version)
+		if self.file_version == 1:
+			self.flags = 0
+			self.frames_start = struct.calcsize(V1_HEADER_FMT)
+		else:
+			self.flags = mm[2]
+			self.frames_start = struct.calcsize(HEADER_FMT)
+		if self.flags == 0:
+			self.decompress = None
+		elif self.flags in CODECS:
+			self.decompress = CODECS[self.flags][1]
+		else:
+			raise DemoError("unsupported demo flags %d" % self.flags)
+		self.frames_end = len(mm)
+		self.table_offset = None
+		self.keyframe_count = 0
+		self.rebuilt = None
+		self.chunk_cache = OrderedDict()
+		if self.file_version >= 2 and len(mm) >= FOOTER_SIZE:
+			magic, frames_end, table_offset, count = struct.unpack_from(
+				FOOTER_FMT, mm, len(mm) - FOOTER_SIZE)
+			if magic == FOOTER_MAGIC:
+				self.frames_end = frames_end
+				self.table_offset = table_offset
+				self.keyframe_count = count
+		if self.table_offset is None and rebuild:
+			self.rebuild_index()
+
+	def close(self):
+		try:
+			self.mm.close()
+		except BufferError:
+			pass # packets are still referenced, the gc will unmap it
+
+	def start_position(self):
+		if self.decompress is None:
+			return self.frames_start
+		return self.frames_start << CHUNK_POSITION_BITS
+
+	def frames(self, position=None):
+		"""Yields (position, timestamp, data) for every frame from position on"""
+		if position is None:
+			position = self.start_position()
+		if self.decompress is not None:
+			for frame in self.chunk_frames(position):
+				yield frame
+			return
+		for frame in iter_frames(self.mm, position, self.frames_end,
+				self.file_version):
+			yield frame
+
+	def chunk_frames(self, position):
+		offset = position >> CHUNK_POSITION_BITS
+		pos = position & CHUNK_POSITION_MASK
+		while offset < self.frames_end:
+			chunk = self.read_chunk(offset)
+			if chunk is None:
+				return # truncated recording
+			raw, next_offset = chunk
+			base = offset << CHUNK_POSITION_BITS
+			for pos, timestamp, data in iter_frames(raw, pos, len(raw),
+					self.file_version):
+				yield base | pos, timestamp, data
+			offset = next_offset
+			pos = 0
+
+	def read_chunk(self, offset):
+		"""Returns the decompressed chunk at offset and the offset of the
+		next one, or None if the chunk is incomplete"""
+		chunk = self.chunk_cache.get(offset)
+		if chunk is not None:
+			self.chunk_cache.move_to_end(offset)
+			return chunk
+		start = offset + CHUNK_HEADER_SIZE
+		if start > self.frames_end:
+			return None
+		size, raw_size = struct.unpack_from(CHUNK_FMT, self.mm, offset)
+		if start + size > self.frames_end:
+			return None
+		chunk = (self.decompress(self.mm[start:start + size]), start + size)
+		self.chunk_cache[offset] = chunk
+		if len(self.chunk_cache) > CHUNK_CACHE_SIZE:
+			self.chunk_cache.popitem(last=False)
+		return chunk
+
+	def rebuild_index(self):
+		"""Recomputes keyframes for files without an index"""
+		index = IndexBuilder()
+		for position, timestamp, data in self.frames():
+			if data[0] == MAP_START:
+				index.start_map(position)
+			elif index.is_due(timestamp) and self.resumable(position):
+				index.add_keyframe(timestamp, position)
+			index.feed(data)
+		self.rebuilt = index
+		self.keyframe_count = len(index.keyframes)
+
+	def resumable(self, position):
+		"""Whether frames(position) yields the right times"""
+		if self.decompress is not None:
+			return position & CHUNK_POSITION_MASK == 0
+		return self.file_version < 3 or self.mm[position] & 1 == 1
+
+	def keyframe(self, index):
+		if self.rebuilt is not None:
+			return self.rebuilt.keyframes[index]
+		return Keyframe(*struct.unpack_from(KEYFRAME_FMT, self.mm,
+			self.table_offset + index * KEYFRAME_SIZE))
+
+	def find_keyframe(self, timestamp):
+		"""Returns (index, keyframe) of the last keyframe at or before
+		timestamp, or (-1, None) if there is none"""
+		lo, hi = 0, self.keyframe_count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.keyframe(mid).time <= timestamp:
+				lo = mid + 1
+			else:
+				hi = mid
+		if lo == 0:
+			return -1, None
+		return lo - 1, self.keyframe(lo - 1)
+
+	def snapshot(self, index):
+		if self.rebuilt is not None:
+			return unpack_snapshot(self.rebuilt.snapshots[index])
+		keyframe = self.keyframe(index)
+		start = keyframe.snapshot_offset
+		return unpack_snapshot(self.mm[start:start + keyframe.snapshot_size])
+
+def catch_up(demo, start, end, index=None, map_packets=None):
+	"""Yields the packets that take a client from position start to end
+	(None for the end of the demo) without the traffic in between: map
+	loads and block edits are passed on, everything else is condensed into
+	its latest state. Players leaving are passed on too until a map load,
+	the client still shows them otherwise. With a keyframe index, frames
+	before the keyframe only contribute map loads, block edits and leaving
+	players and the keyframe's snapshot provides the rest. map_packets, if
+	given, replace those frames, e.g. a map with the edits already applied
+	(see demostate.synthesize_map)."""
+	latch = StateLatch()
+	same_map = True # the client's map is still loaded
+	if index is not None:
+		keyframe = demo.keyframe(index)
+		if map_packets is not None:
+			same_map = False
+			for data in map_packets:
+				yield data
+		else:
+			for position, timestamp, data in demo.frames(start):
+				if position >= keyframe.offset:
+					break
+				if data[0] == MAP_START:
+					same_map = False
+				elif data[0] == PLAYER_LEFT and same_map:
+					yield data
+				if data[0] in CATCH_UP_PACKETS:
+					yield data
+		for data in demo.snapshot(index):
+			latch.feed(data)
+		start = keyframe.offset
+	for position, timestamp, data in demo.frames(start):
+		if end is not None and position >= end:
+			break
+		latch.feed(data)
+		if data[0] == MAP_START:
+			same_map = False
+		elif data[0] == PLAYER_LEFT and same_map:
+			yield data
+		if data[0] in CATCH_UP_PACKETS:
+			yield data
+	for data in latch.snapshot():
+		yield data
+
+def map_name(data):
+	"""Returns the map name of a 0.76 MapStart packet, 0.75 doesn't send it"""
+	if len(data) <= 9:
+		return None
+	return data[9:].split(b'\0', 1)[0].decode('cp437', 'replace') or None
+
+def open_exclusive(path):
+	"""Creates path, or the first free of path-1, path-2... if it exists.
+	Creation is atomic, so concurrent recorders never share a file.
+	Returns (path, file)."""
+	root, ext = os.path.splitext(path)
+	candidate = path
+	i = 0
+	while True:
+		try:
+			fd = os.open(candidate, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+				getattr(os, 'O_BINARY', 0), 0o666)
+		except FileExistsError:
+			i += 1
+			candidate = "%s-%d%s" % (root, i, ext)
+			continue
+		return candidate, os.fdopen(fd, "wb")
+
+class SegmentRecorder(object):
+	"""Records one connection into demo files.
+
+	With split, a new segment file is started at every MapStart, and its
+	timestamps count from the segment's first packet so it plays back on its
+	own. path_for_segment(number, map_name) names the files (map_name is
+	None on 0.75) and on_close(path, sink) is called after each segment.
+	If manifest_path is given, a JSON manifest listing every segment with
+	its start time, map and packet count is kept up to date there."""
+	def __init__(self, path_for_segment, aos_version, compression=None,
+			flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL,
+			on_close=None, split=True, manifest_path=None):
+		self.path_for_segment = path_for_segment
+		self.aos_version = aos_version
+		self.compression = compression
+		self.flush_size = flush_size
+		self.flush_interval = flush_interval
+		self.on_close = on_close
+		self.split = split
+		self.manifest = None
+		self.manifest_path = manifest_path
+		if manifest_path is not None:
+			self.manifest_path, fh = open_exclusive(manifest_path)
+			fh.close()
+			self.manifest = {'aos_version': aos_version, 'segments': []}
+		self.segments = 0
+		self.path = self.fh = self.sink = self.writer = self.segment = None
+		self.segment_start = 0.0
+		self.has_map = False
+		self.map_crc = 0
+	def write(self, timestamp, data):
+		packet_id = data[0]
+		if packet_id == MAP_START and self.has_map and self.split:
+			self.close()
+		if self.writer is None:
+			self.open(timestamp, data)
+		if packet_id == MAP_START:
+			self.has_map = True
+			self.map_crc = 0
+		elif packet_id == MAP_CHUNK:
+			self.map_crc = zlib.crc32(data[1:], self.map_crc)
+		elif packet_id == STATE_DATA and self.segment['map_crc32'] is None:
+			self.segment['map_crc32'] = "%08x" % (self.map_crc & 0xffffffff)
+		self.segment['packets'] += 1
+		self.segment['duration'] = timestamp - self.segment_start
+		self.writer.write(timestamp - self.segment_start, data)
+	def open(self, timestamp, data):
+		name = map_name(data) if data[0] == MAP_START else None
+		self.path, self.fh = open_exclusive(
+			self.path_for_segment(self.segments, name))
+		self.segments += 1
+		self.sink = BufferedSink(self.fh, self.flush_size, self.flush_interval)
+		self.writer = DemoWriter(self.sink, self.aos_version, self.compression)
+		self.segment_start = timestamp if self.split else 0.0
+		self.has_map = False
+		self.segment = {
+			'file': os.path.basename(self.path),
+			'started': datetime.now(timezone.utc).isoformat(),
+			'offset': timestamp,
+			'duration': 0.0,
+			'map': name,
+			'map_crc32': None,
+			'packets': 0,
+			'complete': False,
+		}
+		if self.manifest is not None:
+			self.manifest['segments'].append(self.segment)
+			self.write_manifest()
+	def poll(self):
+		if self.sink is not None:
+			self.sink.poll()
+	def close(self):
+		if self.writer is None:
+			return
+		try:
+			self.writer.close()
+			self.sink.close()
+		finally:
+			self.fh.close()
+		self.segment['complete'] = True
+		if self.manifest is not None:
+			self.write_manifest()
+		if self.on_close is not None:
+			self.on_close(self.path, self.sink)
+		self.path = self.fh = self.sink = self.writer = None
+	def write_manifest(self):
+		tmp = self.manifest_path + ".tmp"
+		with open(tmp, "w") as fh:
+			json.dump(self.manifest, fh, indent=1)
+		os.replace(tmp, self.manifest_path)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Offline analysis of demos recorded with record.py.
+
+As a library:
+
+	from demoanalysis import events, DemoStats
+	kills = sum(1 for event in events('match.demo') if isinstance(event, KillEvent))
+	stats = DemoStats().scan('match.demo')
+
+frames() walks a demo without reading it into memory: uncompressed files
+are read through DemoReader's memory map and every packet is a memoryview
+slice of the mapping. The views are only valid until the next frame is
+requested, so copy them with bytes() if they have to be kept.
+
+As a script it prints packet counts, traffic over time and per-player
+activity for a demo.
+"""
+
+import struct
+from array import array
+from collections import namedtuple
+from aosdemo import (DemoReader, iter_frames, BLOCK_ACTION,
+	BLOCK_LINE, CHAT_MESSAGE, CREATE_PLAYER, EXISTING_PLAYER, KILL_ACTION,
+	PLAYER_LEFT)
+
+PACKET_NAMES = ['PositionData', 'OrientationData', 'WorldUpdate',
+	'InputData', 'WeaponInput', 'HitPacket', 'GrenadePacket', 'SetTool',
+	'SetColor', 'ExistingPlayer', 'ShortPlayerData', 'MoveObject',
+	'CreatePlayer', 'BlockAction', 'BlockLine', 'StateData', 'KillAction',
+	'ChatMessage', 'MapStart', 'MapChunk', 'PlayerLeft', 'TerritoryCapture',
+	'ProgressBar', 'IntelCapture', 'IntelPickup', 'IntelDrop', 'Restock',
+	'FogColor', 'WeaponReload', 'ChangeTeam', 'ChangeWeapon', 'MapCached']
+
+BUILD_BLOCK, DESTROY_BLOCK, SPADE_DESTROY, GRENADE_DESTROY = range(4)
+
+ChatEvent = namedtuple('ChatEvent', 'time player_id chat_type message')
+KillEvent = namedtuple('KillEvent', 'time victim killer kill_type respawn_time')
+BlockEvent = namedtuple('BlockEvent', 'time player_id action x y z')
+BlockLineEvent = namedtuple('BlockLineEvent', 'time player_id x1 y1 z1 x2 y2 z2')
+JoinEvent = namedtuple('JoinEvent', 'time player_id team weapon name')
+LeaveEvent = namedtuple('LeaveEvent', 'time player_id')
+
+def decode_string(data):
+	return bytes(data).split(b'\0', 1)[0].decode('cp437', 'replace')
+
+def decode_chat(timestamp, data):
+	player_id, chat_type = struct.unpack_from('BB', data, 1)
+	return ChatEvent(timestamp, player_id, chat_type, decode_string(data[3:]))
+
+def decode_kill(timestamp, data):
+	return KillEvent(timestamp, *struct.unpack_from('BBBB', data, 1))
+
+def decode_block(timestamp, data):
+	return BlockEvent(timestamp, *struct.unpack_from('<BBiii', data, 1))
+
+def decode_block_line(timestamp, data):
+	return BlockLineEvent(timestamp, *struct.unpack_from('<B6i', data, 1))
+
+def decode_existing_player(timestamp, data):
+	player_id, team, weapon = struct.unpack_from('BbB', data, 1)
+	return JoinEvent(timestamp, player_id, team, weapon, decode_string(data[12:]))
+
+def decode_create_player(timestamp, data):
+	player_id, weapon, team = struct.unpack_from('BBb', data, 1)
+	return JoinEvent(timestamp, player_id, team, weapon, decode_string(data[16:]))
+
+def decode_player_left(timestamp, data):
+	return LeaveEvent(timestamp, data[1])
+
+DECODERS = {
+	CHAT_MESSAGE: decode_chat,
+	KILL_ACTION: decode_kill,
+	BLOCK_ACTION: decode_block,
+	BLOCK_LINE: decode_block_line,
+	EXISTING_PLAYER: decode_existing_player,
+	CREATE_PLAYER: decode_create_player,
+	PLAYER_LEFT: decode_player_left,
+}
+
+def frames(path):
+	"""Yields (timestamp, packet) for every frame of a demo"""
+	demo = DemoReader(path, rebuild=False)
+	try:
+		if demo.decompress is not None:
+			for position, timestamp, data in demo.frames():
+				yield timestamp, memoryview(data)
+			return
+		if demo.frames_end <= demo.frames_start:
+			return
+		view = memoryview(demo.mm)
+		try:
+			for offset, timestamp, data in iter_frames(view,
+					demo.frames_start, demo.frames_end, demo.file_version):
+				yield timestamp, data
+		finally:
+			view.release()
+	finally:
+		demo.close()
+
+def events(path, packet_ids=None):
+	"""Yields typed events for every packet with a decoder"""
+	decoders = DECODERS
+	if packet_ids is not None:
+		decoders = dict((key, value) for key, value in DECODERS.items()
+			if key in packet_ids)
+	for timestamp, data in frames(path):
+		decoder = decoders.get(data[0])
+		if decoder is not None:
+			try:
+				yield decoder(timestamp, data)
+			except struct.error:
+				pass # malformed packet
+
+class PlayerActivity(object):
+	__slots__ = ('name', 'chat', 'kills', 'deaths', 'built', 'destroyed')
+	def __init__(self):
+		self.name = None
+		self.chat = self.kills = self.deaths = self.built = self.destroyed = 0
+
+class DemoStats(object):
+	"""Packet counts, traffic per time bucket and per-player activity"""
+	def __init__(self, bucket=60.0):
+		self.bucket = bucket
+		self.packet_counts = array('Q', [0]) * 256
+		self.packet_bytes = array('Q', [0]) * 256
+		self.bytes_over_time = array('Q')
+		self.players = {}
+		self.duration = 0.0
+
+	def player(self, player_id):
+		activity = self.players.get(player_id)
+		if activity is None:
+			activity = self.players[player_id] = PlayerActivity()
+		return activity
+
+	def scan(self, path):
+		packet_counts = self.packet_counts
+		packet_bytes = self.packet_bytes
+		bytes_over_time = self.bytes_over_time
+		bucket = self.bucket
+		timestamp = 0.0
+		for timestamp, data in frames(path):
+			packet_id = data[0]
+			size = len(data)
+			packet_counts[packet_id] += 1
+			packet_bytes[packet_id] += size
+			index = int(timestamp / bucket)
+			if index >= len(bytes_over_time):
+				bytes_over_time.extend([0] * (index + 1 - len(bytes_over_time)))
+			bytes_over_time[index] += size
+			decoder = DECODERS.get(packet_id)
+			if decoder is not None:
+				try:
+					self.add_event(decoder(timestamp, data))
+				except struct.error:
+					pass
+		self.duration = max(self.duration, timestamp)
+		return self
+
+	def add_event(self, event):
+		if isinstance(event, ChatEvent):
+			self.player(event.player_id).chat += 1
+		elif isinstance(event, KillEvent):
+			self.player(event.victim).deaths += 1
+			if event.killer != event.victim:
+				self.player(event.killer).kills += 1
+		elif isinstance(event, BlockEvent):
+			if event.action == BUILD_BLOCK:
+				self.player(event.player_id).built += 1
+			else:
+				self.player(event.player_id).destroyed += 1
+		elif isinstance(event, BlockLineEvent):
+			self.player(event.player_id).built += 1
+		elif isinstance(event, JoinEvent):
+			self.player(event.player_id).name = event.name
+
+	def report(self):
+		lines = ["duration: %.1f s" % self.duration, "", "packets:"]
+		for packet_id, count in enumerate(self.packet_counts):
+			if count:
+				if packet_id < len(PACKET_NAMES):
+					name = PACKET_NAMES[packet_id]
+				else:
+					name = "unknown %d" % packet_id
+				lines.append("  %-17s %9d %12d bytes" % (name, count,
+					self.packet_bytes[packet_id]))
+		lines += ["", "traffic per %g s:" % self.bucket]
+		for index, size in enumerate(self.bytes_over_time):
+			lines.append("  %8g %12d bytes" % (index * self.bucket, size))
+		lines += ["", "players:", "  %3s %-16s %6s %6s %6s %6s %9s" % ("id",
+			"name", "chat", "kills", "deaths", "built", "destroyed")]
+		for player_id in sorted(self.players):
+			activity = self.players[player_id]
+			lines.append("  %3d %-16s %6d %6d %6d %6d %9d" % (player_id,
+				activity.name or "?", activity.chat, activity.kills,
+				activity.deaths, activity.built, activity.destroyed))
+		return "\n".join(lines)
+
+if __name__ == '__main__':
+	import argparse
+	parser  = argparse.ArgumentParser(description="Summarize a demo")
+	parser.add_argument('file', help="Demo to analyze")
+	parser.add_argument('--bucket', type=float, default=60.0, help="Seconds per traffic bucket (default: 60)")
+	args = parser.parse_args()
+	print(DemoStats(args.bucket).scan(args.file).report())
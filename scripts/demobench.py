@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the demo code: for every storage format (raw version 1, the
+current version raw and in every available compressed container) it reports
+file size, record throughput through SegmentRecorder, decode throughput
+and seek latency, then measures the CPU cost of a playback viewer against
+stand-in viewers, which needs no ENet.
+
+Without a demo file a synthetic one is generated, with --players, --duration
+and --mix (packets per player and second, WorldUpdate per server) deciding
+what's in it: players walk around a generated heightmap and their positions
+in WorldUpdate change smoothly, so compression sees data like a real
+game's. The same seed gives the same demo, so results can be saved
+with --save and later runs checked against them with --baseline, which
+exits with status 1 if any metric got worse by more than --tolerance.
+
+	demobench.py --players 32 --duration 600 --mix BlockAction=2,ChatMessage=0.5
+"""
+
+import argparse
+parser  = argparse.ArgumentParser(description="Benchmark the demo code")
+parser.add_argument('file', nargs='?', help="Demo to benchmark with (default: generate one)")
+parser.add_argument('--players', type=int, default=16, help="Players in the synthetic demo (default: 16)")
+parser.add_argument('--duration', type=float, default=300.0, help="Seconds of synthetic gameplay (default: 300)")
+parser.add_argument('--mix', default="", metavar='NAME=RATE,...', help="Override packet rates of the synthetic demo")
+parser.add_argument('--seed', type=int, default=1, help="Seed for the synthetic demo (default: 1)")
+parser.add_argument('--repeat', type=int, default=3, help="Decode each file this many times and keep the best run (default: 3)")
+parser.add_argument('--seeks', type=int, default=50, help="Random seeks per format (default: 50)")
+parser.add_argument('--viewers', type=int, default=8, help="Stand-in viewers for the playback benchmark (default: 8)")
+parser.add_argument('--save', metavar='FILE', help="Save the results as JSON")
+parser.add_argument('--baseline', metavar='FILE', help="Compare with results saved by --save")
+parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed slowdown against the baseline (default: 0.25)")
+args = parser.parse_args()
+
+import json
+import math
+import os
+import random
+import struct
+import sys
+import tempfile
+import zlib
+from time import perf_counter, process_time
+from aosdemo import (DemoReader, SegmentRecorder, COMPRESSION_FLAGS, FILE_VERSION,
+	FRAME_FMT, WORLD_UPDATE, INPUT_DATA, WEAPON_INPUT, SET_TOOL, SET_COLOR,
+	EXISTING_PLAYER, BLOCK_ACTION, BLOCK_LINE, STATE_DATA, KILL_ACTION,
+	CHAT_MESSAGE, MAP_START, MAP_CHUNK, catch_up)
+from demoanalysis import PACKET_NAMES
+from demostate import World, MAP_X, MAP_Y, MAP_CHUNK_SIZE
+
+# packets per player and second, except WorldUpdate which is per server
+DEFAULT_MIX = {
+	WORLD_UPDATE: 10.0,
+	INPUT_DATA: 2.0,
+	WEAPON_INPUT: 1.0,
+	SET_TOOL: 0.2,
+	SET_COLOR: 0.1,
+	BLOCK_ACTION: 0.5,
+	BLOCK_LINE: 0.05,
+	CHAT_MESSAGE: 0.05,
+	KILL_ACTION: 0.03,
+}
+TICK = 1 / 60.
+MAX_PLAYERS = 32
+WALK_SPEED = 4.0 # blocks per second
+
+def parse_mix(text):
+	mix = dict(DEFAULT_MIX)
+	for item in text.split(','):
+		if not item:
+			continue
+		name, _, rate = item.partition('=')
+		if name not in PACKET_NAMES or PACKET_NAMES.index(name) not in DEFAULT_MIX:
+			raise ValueError("can't generate %s packets" % name)
+		mix[PACKET_NAMES.index(name)] = float(rate)
+	return mix
+
+def terrain_height(x, y):
+	"""z of the ground of the synthetic map, rolling hills between 20 and 50"""
+	return int(35 + 8 * math.sin(x / 23.) + 6 * math.cos(y / 31.) +
+		4 * math.sin((x + y) / 11.))
+
+def synthetic_map(rng):
+	"""Returns a zlib compressed vxl of hills with grass and dirt colors,
+	the way a server sends its map"""
+	world = World()
+	columns = world.columns
+	colors = world.colors
+	for x in range(MAP_X):
+		for y in range(MAP_Y):
+			column = (x << 9) | y
+			top = terrain_height(x, y)
+			columns[column] = ~((1 << top) - 1) & ((1 << 64) - 1)
+			base = (column << 6) + top
+			for depth in range(4): # the sides of steep slopes show dirt
+				shade = rng.randrange(8)
+				if depth == 0:
+					colors[base] = 0x306020 + (top << 9) + shade * 0x010101
+				else:
+					colors[base + depth] = 0x604020 + shade * 0x010101
+	return zlib.compress(world.to_vxl())
+
+class Walker(object):
+	"""A player strolling over the map, turning a little every update"""
+	def __init__(self, rng):
+		self.x = rng.uniform(0, MAP_X)
+		self.y = rng.uniform(0, MAP_Y)
+		self.heading = rng.uniform(0, 2 * math.pi)
+		self.pitch = 0.0
+	def step(self, rng, dt):
+		self.heading += rng.gauss(0, 0.05)
+		self.pitch = max(-1.0, min(1.0, self.pitch + rng.gauss(0, 0.02)))
+		self.x = (self.x + math.cos(self.heading) * WALK_SPEED * dt) % MAP_X
+		self.y = (self.y + math.sin(self.heading) * WALK_SPEED * dt) % MAP_Y
+	def pack(self):
+		z = terrain_height(int(self.x), int(self.y)) - 2.4 # eye height
+		cos_pitch = math.cos(self.pitch)
+		return struct.pack('<6f', self.x, self.y, z,
+			math.cos(self.heading) * cos_pitch,
+			math.sin(self.heading) * cos_pitch, math.sin(self.pitch))
+
+def world_update(rng, walkers, dt):
+	"""Moves every walker and returns their WorldUpdate, empty slots
+	zeroed like the server does"""
+	data = bytearray([WORLD_UPDATE])
+	for walker in walkers:
+		walker.step(rng, dt)
+		data += walker.pack()
+	data += bytes(24 * (MAX_PLAYERS - len(walkers)))
+	return bytes(data)
+
+def synthetic_packet(rng, packet_id, player, players):
+	if packet_id in (INPUT_DATA, WEAPON_INPUT, SET_TOOL):
+		return struct.pack('BBB', packet_id, player, rng.getrandbits(3))
+	if packet_id == SET_COLOR:
+		return struct.pack('BB3B', packet_id, player, *rng.getrandbits(24).to_bytes(3, 'little'))
+	if packet_id == BLOCK_ACTION:
+		return struct.pack('<BBBiii', packet_id, player, rng.randrange(4),
+			rng.randrange(512), rng.randrange(512), rng.randrange(64))
+	if packet_id == BLOCK_LINE:
+		x, y, z = rng.randrange(500), rng.randrange(500), rng.randrange(50)
+		return struct.pack('<BB6i', packet_id, player, x, y, z,
+			x + rng.randrange(10), y, z + rng.randrange(10))
+	if packet_id == CHAT_MESSAGE:
+		return struct.pack('BBB', packet_id, player, 0) + b"good game\0"
+	if packet_id == KILL_ACTION:
+		return struct.pack('BBBBB', packet_id, player, rng.randrange(players),
+			rng.randrange(4), 5)
+
+def synthetic_frames(players=16, duration=300.0, mix=DEFAULT_MIX, seed=1):
+	"""Yields (timestamp, packet) for a made up game: a map transfer,
+	the players joining, and packets at the rates in mix"""
+	rng = random.Random(seed)
+	players = min(players, MAX_PLAYERS)
+	map_data = synthetic_map(rng)
+	yield 0.0, struct.pack('<BI', MAP_START, len(map_data))
+	for offset in range(0, len(map_data), MAP_CHUNK_SIZE):
+		yield 0.0, bytes([MAP_CHUNK]) + map_data[offset:offset + MAP_CHUNK_SIZE]
+	state = bytearray(52)
+	state[0] = STATE_DATA
+	state[1] = players # the recorder takes the next free id
+	yield 0.1, bytes(state)
+	for player in range(players):
+		yield 0.1, struct.pack('<BBbBBI3B', EXISTING_PLAYER, player,
+			player % 2, 0, 2, 0, 0x10, 0x20, 0x30) + b"player%d\0" % player
+	walkers = [Walker(rng) for player in range(players)]
+	last_update = 0.1
+	carry = dict((packet_id, 0.0) for packet_id in mix)
+	timestamp = 0.1
+	while timestamp < duration:
+		timestamp += TICK
+		for packet_id, rate in sorted(mix.items()):
+			if packet_id != WORLD_UPDATE:
+				rate *= players
+			carry[packet_id] += rate * TICK
+			while carry[packet_id] >= rng.random():
+				carry[packet_id] -= 1
+				if packet_id == WORLD_UPDATE:
+					packet = world_update(rng, walkers, timestamp - last_update)
+					last_update = timestamp
+				else:
+					packet = synthetic_packet(rng, packet_id,
+						rng.randrange(players), players)
+				yield timestamp, packet
+
+def write_v1(path, aos_version, frames):
+	with open(path, "wb") as fh:
+		fh.write(struct.pack('BB', 1, aos_version))
+		for timestamp, data in frames:
+			fh.write(struct.pack(FRAME_FMT, timestamp, len(data)))
+			fh.write(data)
+
+def record(path, aos_version, frames, compression):
+	"""Writes frames the way record.py does"""
+	recorder = SegmentRecorder(lambda segment, map_name: path, aos_version,
+		compression, split=False)
+	for count, (timestamp, data) in enumerate(frames):
+		recorder.write(timestamp, data)
+		if count & 255 == 0:
+			recorder.poll()
+	recorder.close()
+
+def decode(path):
+	demo = DemoReader(path)
+	count = size = 0
+	for position, timestamp, data in demo.frames():
+		count += 1
+		size += len(data)
+	demo.close()
+	return count, size
+
+def seek_latency(path, times):
+	"""Returns the seconds it took to prepare a seek to each time"""
+	demo = DemoReader(path)
+	latencies = []
+	for timestamp in times:
+		start = perf_counter()
+		index, keyframe = demo.find_keyframe(timestamp)
+		if keyframe is not None:
+			for data in catch_up(demo, keyframe.map_offset, keyframe.offset, index):
+				pass
+		latencies.append(perf_counter() - start)
+	demo.close()
+	return latencies
+
+class LoopbackViewer(object):
+	"""Stands in for a demoserver Client and counts what would have been
+	sent, without building ENet packets"""
+	def __init__(self):
+		self.playback = None
+		self.playerid = None
+		self.packets = self.bytes = 0
+	def send(self, data):
+		if data[0] == STATE_DATA:
+			self.playerid = data[1]
+		self.packets += 1
+		self.bytes += len(data)
+
+def playback_cpu(path, viewers, step=0.01):
+	"""Returns the CPU seconds it takes playback to serve the whole demo
+	to this many stand-in viewers, stepping its clock by step"""
+	from demoserver import Scheduler, Playback
+	demo = DemoReader(path)
+	scheduler = Scheduler()
+	start = process_time()
+	playback = Playback(demo, scheduler, 0.0)
+	for i in range(viewers):
+		playback.attach(LoopbackViewer())
+	now = 0.0
+	try:
+		while True:
+			now += step
+			playback.advance(now)
+	except EOFError:
+		pass
+	elapsed = process_time() - start
+	demo.close()
+	return elapsed
+
+def percentile(values, fraction):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def compare(metrics, baseline, tolerance):
+	"""Prints the change of every metric and returns the regressed ones.
+	Metrics ending in /s are better when higher, all others when lower."""
+	regressions = []
+	print("%-32s %14s %14s %8s" % ("metric", "baseline", "now", "change"))
+	for name in sorted(metrics):
+		old = baseline.get(name)
+		if not old:
+			continue
+		change = (metrics[name] - old) / old
+		worse = -change if name.endswith("/s") else change
+		marker = ""
+		if worse > tolerance:
+			regressions.append(name)
+			marker = " REGRESSION"
+		print("%-32s %14.2f %14.2f %+7.1f%%%s" % (name, old, metrics[name],
+			100 * change, marker))
+	return regressions
+
+if args.file is not None:
+	source = DemoReader(args.file)
+	frames = [(timestamp, bytes(data)) for position, timestamp, data in source.frames()]
+	aos_version = source.aos_version
+	source.close()
+else:
+	try:
+		mix = parse_mix(args.mix)
+	except ValueError as e:
+		print("ERROR:", e)
+		sys.exit(1)
+	frames = list(synthetic_frames(args.players, args.duration, mix, args.seed))
+	aos_version = 3
+payload = sum(len(data) for timestamp, data in frames)
+duration = frames[-1][0] if frames else 0.0
+print("%d frames, %.1f MiB of packets, %.0f s" % (len(frames),
+	payload / 1048576., duration))
+
+metrics = {}
+seek_times = [random.Random(args.seed).uniform(0, duration) for _ in range(args.seeks)]
+# version 1 files have no index, so their decode time includes rebuilding it
+current = "v%d " % FILE_VERSION
+formats = [("v1 raw", None), (current + "raw", None)]
+formats += [(current + name, name) for name in sorted(COMPRESSION_FLAGS)]
+print("%-10s %12s %7s %11s %12s %12s %9s %9s" % ("format", "bytes", "ratio",
+	"record pk/s", "decode MB/s", "frames/s", "seek ms", "seek p95"))
+with tempfile.TemporaryDirectory() as tmp:
+	for label, compression in formats:
+		path = os.path.join(tmp, "bench-%s.demo" % label.replace(" ", "-"))
+		start = perf_counter()
+		if label == "v1 raw":
+			write_v1(path, aos_version, frames)
+		else:
+			record(path, aos_version, frames, compression)
+		write_time = perf_counter() - start
+		best = None
+		for _ in range(max(args.repeat, 1)):
+			start = perf_counter()
+			count, size = decode(path)
+			elapsed = perf_counter() - start
+			best = elapsed if best is None else min(best, elapsed)
+		best = max(best, 1e-9)
+		latencies = seek_latency(path, seek_times) or [0.0]
+		file_size = os.path.getsize(path)
+		results = {
+			"bytes": file_size,
+			"record packets/s": len(frames) / max(write_time, 1e-9),
+			"decode MB/s": size / 1e6 / best,
+			"decode frames/s": count / best,
+			"seek avg ms": 1000 * sum(latencies) / len(latencies),
+			"seek p95 ms": 1000 * percentile(latencies, 0.95),
+		}
+		for name, value in results.items():
+			metrics["%s %s" % (label, name)] = value
+		print("%-10s %12d %6.1f%% %11d %12.1f %12d %9.2f %9.2f" % (label,
+			file_size, 100. * file_size / max(payload, 1),
+			results["record packets/s"], results["decode MB/s"],
+			results["decode frames/s"], results["seek avg ms"],
+			results["seek p95 ms"]))
+		if label == current + "raw":
+			viewer_demo = path
+
+	idle = playback_cpu(viewer_demo, 0)
+	busy = playback_cpu(viewer_demo, args.viewers)
+	per_viewer = (busy - idle) / max(args.viewers, 1)
+	minutes = max(duration / 60., 1e-9)
+	metrics["playback base ms/min"] = 1000 * idle / minutes
+	metrics["playback viewer ms/min"] = 1000 * per_viewer / minutes
+	print("playback: %.1f ms CPU per demo minute, plus %.1f ms per viewer (%d viewers)" % (
+		metrics["playback base ms/min"], metrics["playback viewer ms/min"],
+		args.viewers))
+
+if args.save:
+	with open(args.save, "w") as fh:
+		json.dump(metrics, fh, indent=1, sort_keys=True)
+if args.baseline:
+	with open(args.baseline) as fh:
+		baseline = json.load(fh)
+	if compare(metrics, baseline, args.tolerance):
+		sys.exit(1)
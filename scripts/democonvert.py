@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Converts demos to the current file version, e.g. version 1 and 2 demos with
+float timestamps to version 3 with microsecond timestamps and an index.
+
+	democonvert.py old/*.demo
+	democonvert.py --output converted/ --compress zlib old/*.demo
+
+Files are replaced in place unless --output is given. Demos that already
+are in the current version (and compression) are left alone.
+"""
+
+import argparse
+parser  = argparse.ArgumentParser(description="Convert demos to the current version")
+parser.add_argument('files', nargs='+', metavar='file', help="Demos to convert")
+parser.add_argument('--output', metavar='DIR', help="Write the converted demos to this directory instead of replacing them")
+parser.add_argument('--compress', choices=['zlib', 'lzma'], help="Compress the converted demos")
+args = parser.parse_args()
+
+import os
+import sys
+from aosdemo import DemoReader, DemoError, FILE_VERSION, COMPRESSION_FLAGS
+from demofilter import filter_demo
+
+if args.output is not None:
+	os.makedirs(args.output, exist_ok=True)
+flags = COMPRESSION_FLAGS[args.compress] if args.compress else 0
+failed = False
+for path in args.files:
+	try:
+		demo = DemoReader(path, rebuild=False)
+	except (DemoError, OSError) as e:
+		print("%s: %s" % (path, e))
+		failed = True
+		continue
+	version = demo.file_version
+	current = version == FILE_VERSION and demo.flags == flags
+	demo.close()
+	if args.output is not None:
+		destination = os.path.join(args.output, os.path.basename(path))
+	elif current:
+		print("%s: already version %d" % (path, version))
+		continue
+	else:
+		destination = path
+	try:
+		frames_in, frames_out, bytes_in, bytes_out = filter_demo(path,
+			destination, compression=args.compress)
+	except (DemoError, OSError) as e:
+		print("%s: %s" % (path, e))
+		failed = True
+		continue
+	print("%s: version %d -> %d, %d frames, %d bytes" % (path, version,
+		FILE_VERSION, frames_out, bytes_out))
+if failed:
+	sys.exit(1)
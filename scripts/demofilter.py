@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Rewrites a demo without the packets you don't need.
+
+	demofilter.py match.demo archive.demo --drop OrientationData,InputData --keep-every WorldUpdate:10
+
+Packets are named as in demoanalysis.PACKET_NAMES or given by id. Dropped
+ids are left out entirely, --keep-every ID:N keeps only every Nth packet
+of that id. The map transfer and StateData are always kept, so the result
+plays back like the original. Frames are streamed from the memory mapped
+input to the output, so memory use doesn't grow with the size of the demo
+(only the keyframe index of the output is kept until the end).
+"""
+
+import os
+from aosdemo import (DemoReader, DemoWriter, DemoError, MAP_START, MAP_CHUNK,
+	STATE_DATA)
+from demoanalysis import PACKET_NAMES
+
+# without these the output has no map to play on
+REQUIRED_PACKETS = (MAP_START, MAP_CHUNK, STATE_DATA)
+
+def packet_id(name):
+	"""Returns the id for a packet name or number"""
+	lowered = name.lower()
+	for packet_id, packet_name in enumerate(PACKET_NAMES):
+		if packet_name.lower() == lowered:
+			return packet_id
+	try:
+		packet_id = int(name)
+	except ValueError:
+		raise DemoError("unknown packet %s" % name)
+	if not 0 <= packet_id < 256:
+		raise DemoError("unknown packet %s" % name)
+	return packet_id
+
+def filter_demo(source, destination, drop=(), keep_every=None,
+		compression=None):
+	"""Copies the demo at source to destination, leaving out the packet
+	ids in drop and keeping one in every keep_every[id] of the others.
+	Returns (frames read, frames written, bytes read, bytes written)."""
+	keep_every = dict(keep_every or {})
+	for packet_id in list(drop) + list(keep_every):
+		if packet_id in REQUIRED_PACKETS:
+			raise DemoError("%s can't be removed" % PACKET_NAMES[packet_id])
+	keep = [1] * 256
+	for packet_id in drop:
+		keep[packet_id] = 0
+	for packet_id, every in keep_every.items():
+		if every < 1:
+			raise DemoError("keep every must be at least 1")
+		keep[packet_id] = every
+	seen = [0] * 256
+	frames_in = frames_out = bytes_in = 0
+	demo = DemoReader(source, rebuild=False)
+	tmp = destination + ".tmp"
+	try:
+		with open(tmp, "wb") as fh:
+			writer = DemoWriter(fh, demo.aos_version, compression)
+			for position, timestamp, data in demo.frames():
+				frames_in += 1
+				bytes_in += len(data)
+				packet_id = data[0]
+				every = keep[packet_id]
+				if every == 0:
+					continue
+				if every > 1:
+					count = seen[packet_id]
+					seen[packet_id] = count + 1
+					if count % every:
+						continue
+				writer.write(timestamp, data)
+				frames_out += 1
+			writer.close()
+		os.replace(tmp, destination)
+	except BaseException:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		raise
+	finally:
+		demo.close()
+	return frames_in, frames_out, bytes_in, os.path.getsize(destination)
+
+if __name__ == '__main__':
+	import argparse
+	import sys
+	parser  = argparse.ArgumentParser(description="Drop or thin out packets in a demo")
+	parser.add_argument('source', help="Demo to read")
+	parser.add_argument('destination', help="Demo to write")
+	parser.add_argument('--drop', default="", metavar='IDS', help="Comma separated packets to leave out, e.g. OrientationData,3")
+	parser.add_argument('--keep-every', action='append', default=[], metavar='ID:N', help="Keep only every Nth packet of ID, e.g. WorldUpdate:10 (repeatable)")
+	parser.add_argument('--compress', choices=['zlib', 'lzma'], help="Compress the output")
+	args = parser.parse_args()
+	if os.path.abspath(args.source) == os.path.abspath(args.destination):
+		print("ERROR: source and destination are the same file")
+		sys.exit(1)
+	try:
+		drop = [packet_id(name) for name in args.drop.split(',') if name]
+		keep_every = {}
+		for spec in args.keep_every:
+			name, _, every = spec.rpartition(':')
+			keep_every[packet_id(name)] = int(every)
+		frames_in, frames_out, bytes_in, bytes_out = filter_demo(args.source,
+			args.destination, drop, keep_every, args.compress)
+	except (DemoError, ValueError) as e:
+		print("ERROR:", e)
+		sys.exit(1)
+	print("kept %d of %d frames, wrote %d bytes (input had %d bytes of packets)" % (
+		frames_out, frames_in, bytes_out, bytes_in))
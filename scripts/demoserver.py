@@ -0,0 +1,505 @@
+"""
+Serving logic of playback.py: a timer heap, the playback of one demo
+timeline, the clients watching it and a library of demos to choose from.
+record.py's relay uses it to serve the game it records: LiveDemo holds the
+stream in memory in place of a demo file.
+
+Playback never touches the network itself, it hands packets to its
+clients, anything with send(data). Only Client and Relay need pyenet, so
+demobench.py can measure the cost of a viewer against stand-in viewers
+without it.
+"""
+
+import heapq
+import itertools
+import os
+import struct
+from bisect import bisect_right
+from collections import OrderedDict
+from time import time
+try:
+	import enet
+except ImportError: # only Client and Relay use it
+	enet = None
+from aosdemo import (DemoReader, IndexBuilder, unpack_snapshot, MAP_START,
+	STATE_DATA, WORLD_UPDATE, INPUT_DATA, WEAPON_INPUT, BLOCK_ACTION,
+	PLAYER_LEFT, CREATE_PLAYER, EXISTING_PLAYER,
+	BLOCK_LINE, CATCH_UP_PACKETS, catch_up)
+from demostate import synthesize_map
+
+DEMO_EXTENSION = ".demo"
+LIBRARY_CACHE_SIZE = 8
+MIN_SPEED = 0.25
+MAX_SPEED = 16.0
+MAX_BURST = 64 # packets per client every BURST_INTERVAL
+BURST_INTERVAL = 0.01
+RELAY_DELAY = 10.0 # seconds
+RELAY_POLL = 50 # ms the recorder may block while relaying
+COMPACT_INTERVAL = 1024 # frames
+# packets that change which map or players there are: coalesced updates due
+# before them are sent first, they would apply to the wrong ones afterwards
+COALESCE_BARRIERS = (MAP_START, STATE_DATA, PLAYER_LEFT, CREATE_PLAYER,
+	EXISTING_PLAYER)
+SYNTHESIZE_EDITS = 10000 # block edits that are worth a fresh map transfer
+SYNTHESIZED_CACHE_SIZE = 4 # maps
+
+def chat_packet(message):
+	return struct.pack("bbb", 17, 35, 2) + message.encode('cp437', 'replace') #chat message
+
+class Scheduler(object):
+	"""Runs callbacks when they are due and tells the network loop how long
+	it may block until then"""
+	def __init__(self):
+		self.queue = []
+		self.counter = itertools.count()
+	def call_at(self, when, callback):
+		entry = [when, next(self.counter), callback]
+		heapq.heappush(self.queue, entry)
+		return entry
+	def cancel(self, entry):
+		if entry is not None:
+			entry[2] = None
+	def run(self, now):
+		while self.queue and self.queue[0][0] <= now:
+			when, _, callback = heapq.heappop(self.queue)
+			if callback is not None:
+				callback()
+	def timeout(self, now, limit=1000):
+		"""Milliseconds until the next callback is due, rounded down so the
+		last fraction of a millisecond is spent polling"""
+		while self.queue and self.queue[0][2] is None:
+			heapq.heappop(self.queue)
+		if not self.queue:
+			return limit
+		return max(0, min(limit, int((self.queue[0][0] - now) * 1000)))
+
+synthesized_maps = OrderedDict()
+
+def fresh_map(demo, start, index):
+	"""Returns packets that load the map at keyframe index with its block
+	edits applied, if at least SYNTHESIZE_EDITS of them lie between start
+	and the keyframe, otherwise None and the edits are cheaper to replay.
+	The last few maps are kept, a cinema's viewers join at the same
+	keyframes."""
+	key = (demo, index)
+	if key in synthesized_maps:
+		synthesized_maps.move_to_end(key)
+		return synthesized_maps[key]
+	end = demo.keyframe(index).offset
+	edits = 0
+	for position, timestamp, data in demo.frames(start):
+		if position >= end:
+			return None
+		if data[0] == BLOCK_ACTION or data[0] == BLOCK_LINE:
+			edits += 1
+			if edits >= SYNTHESIZE_EDITS:
+				break
+	else:
+		return None
+	packets = synthesize_map(demo, index)
+	synthesized_maps[key] = packets
+	while len(synthesized_maps) > SYNTHESIZED_CACHE_SIZE:
+		synthesized_maps.popitem(last=False)
+	return packets
+
+class DemoLibrary(object):
+	"""The demos in a directory, opened on demand.
+
+	Open demos are shared by every playback of them, so their memory map,
+	index and chunk cache are only set up once. Up to size demos that
+	nobody plays are kept open for the next viewer, least recently used
+	ones are closed first."""
+	def __init__(self, directory, size=LIBRARY_CACHE_SIZE):
+		self.directory = directory
+		self.size = size
+		self.demos = OrderedDict()
+		self.users = {}
+	def names(self):
+		return sorted(name for name in os.listdir(self.directory)
+			if name.endswith(DEMO_EXTENSION))
+	def acquire(self, name):
+		"""Returns the open demo called name, release() it when done"""
+		demo = self.demos.get(name)
+		if demo is None:
+			if name not in self.names():
+				raise KeyError(name) # also keeps paths out of the directory
+			demo = DemoReader(os.path.join(self.directory, name))
+			self.demos[name] = demo
+		else:
+			self.demos.move_to_end(name)
+		self.users[name] = self.users.get(name, 0) + 1
+		self.evict()
+		return demo
+	def release(self, name):
+		self.users[name] -= 1
+		if self.users[name] == 0:
+			del self.users[name]
+		self.evict()
+	def evict(self):
+		unused = [name for name in self.demos if name not in self.users]
+		for name in unused[:max(0, len(self.demos) - self.size)]:
+			self.demos.pop(name).close()
+	def close(self):
+		for demo in self.demos.values():
+			demo.close()
+		self.demos.clear()
+
+class Playback(object):
+	"""Decodes the demo once and sends it to every attached client.
+	on_finished(playback) is called when the demo ends.
+
+	With synthesize_maps, clients that join late or skip ahead past many
+	block edits get the map as it is at the nearest keyframe, rather than
+	the recorded map and every edit since. Rebuilding a map that isn't
+	cached blocks the caller for seconds, so it is off by default."""
+	synthesize_maps = False
+	def __init__(self, demo, scheduler, start_time, on_finished=None,
+			name=None):
+		self.demo = demo
+		self.name = name
+		self.scheduler = scheduler
+		self.on_finished = on_finished
+		self.frames = demo.frames()
+		self.map_offset = None
+		self.start_time = start_time
+		self.pause_time = 0
+		self.speed = 1.0
+		self.throttle_until = 0
+		self.playerinfo = [[0,0] for _ in range(32)]
+		self.clients = []
+		self.timer = None
+		self.finished = False
+		self.get_next_packet()
+		self.schedule()
+	def get_next_packet(self):
+		try:
+			self.offset, self.timedelta, self.data = next(self.frames)
+		except StopIteration:
+			raise EOFError("replay file finished")
+		if self.data[0] == MAP_START:
+			self.map_offset = self.offset
+	def attach(self, client):
+		# a late joiner gets the state at the current position without
+		# the traffic before it
+		if self.offset > self.demo.start_position() or self.finished:
+			# at the end everything up to the last packet was sent
+			end = None if self.finished else self.offset
+			index, keyframe = self.demo.find_keyframe(self.timedelta)
+			if keyframe is None or keyframe.offset > self.offset:
+				packets = catch_up(self.demo, self.demo.start_position(), end)
+			else:
+				packets = catch_up(self.demo, keyframe.map_offset, end, index,
+					self.fresh_map(keyframe.map_offset, index))
+			for data in packets:
+				client.send(data)
+		client.playback = self
+		self.clients.append(client)
+	def detach(self, client):
+		self.clients.remove(client)
+	def send(self, data):
+		for cl in self.clients:
+			cl.send(data)
+	def schedule(self):
+		self.scheduler.cancel(self.timer)
+		self.timer = None
+		if self.pause_time == 0:
+			self.timer = self.scheduler.call_at(max(self.due_time(), self.throttle_until), self.on_due)
+	def stop(self):
+		self.scheduler.cancel(self.timer)
+		self.timer = None
+	def on_due(self):
+		self.timer = None
+		try:
+			self.advance()
+		except EOFError:
+			self.finished = True
+			if self.on_finished is not None:
+				self.on_finished(self)
+		else:
+			self.schedule()
+	def resume(self):
+		"""Picks up after the end of a demo that has grown since"""
+		try:
+			self.get_next_packet()
+		except EOFError:
+			return
+		self.finished = False
+		self.schedule()
+	def pause(self):
+		self.pause_time = time()
+		self.schedule()
+	def unpause(self):
+		self.start_time += time() - self.pause_time
+		self.pause_time = 0
+		self.schedule()
+	def advance(self, now=None):
+		"""Sends every packet that is due, at most MAX_BURST of them per
+		BURST_INTERVAL. Of the world updates and input states due at once
+		only the latest is sent, before any of COALESCE_BARRIERS that
+		follows them. Raises EOFError at the end"""
+		if now is None:
+			now = time()
+		latest = {}
+		sent = 0
+		try:
+			while self.due_time() <= now:
+				if sent >= MAX_BURST:
+					self.throttle_until = now + BURST_INTERVAL
+					break
+				packet_id = self.data[0]
+				if packet_id == WORLD_UPDATE:
+					latest[packet_id] = self.data
+				elif packet_id == INPUT_DATA or packet_id == WEAPON_INPUT:
+					player, data = struct.unpack("xbb", self.data)
+					self.playerinfo[player][packet_id == WEAPON_INPUT] = data
+					latest[(packet_id, player)] = self.data
+				else:
+					if latest and packet_id in COALESCE_BARRIERS:
+						for data in latest.values():
+							self.send(data)
+						sent += len(latest)
+						latest.clear()
+					self.send(self.data)
+					sent += 1
+				self.get_next_packet()
+		finally:
+			for data in latest.values():
+				self.send(data)
+	def clock_time(self):
+		if self.pause_time > 0:
+			return self.pause_time
+		return time()
+	def demo_time(self):
+		return (self.clock_time() - self.start_time) * self.speed
+	def due_time(self):
+		return self.start_time + self.timedelta / self.speed
+	def set_speed(self, speed):
+		timestamp = self.demo_time()
+		self.speed = speed
+		self.start_time = self.clock_time() - timestamp / speed
+		self.schedule()
+	def seek(self, timestamp):
+		# jump to the last keyframe before timestamp, only forwarding what
+		# keeps the client's map consistent, then play the rest normally.
+		# going back reloads the map, the client's copy is ahead of it
+		index, keyframe = self.demo.find_keyframe(timestamp)
+		if timestamp < self.demo_time():
+			if keyframe is None:
+				self.map_offset = None
+				self.frames = self.demo.frames()
+				self.get_next_packet()
+			else:
+				self.jump(keyframe.map_offset, index, keyframe)
+		elif keyframe is not None and keyframe.offset > self.offset:
+			if keyframe.map_offset == self.map_offset:
+				self.jump(self.offset, index, keyframe)
+			else:
+				self.jump(keyframe.map_offset, index, keyframe)
+		self.start_time = self.clock_time() - max(timestamp, 0) / self.speed
+		self.schedule()
+	def fresh_map(self, start, index):
+		if not self.synthesize_maps:
+			return None
+		return fresh_map(self.demo, start, index)
+	def jump(self, start, index, keyframe):
+		if self.clients:
+			map_packets = self.fresh_map(start, index)
+			if map_packets is not None:
+				start = keyframe.map_offset # replaces the client's map
+			for data in catch_up(self.demo, start, keyframe.offset, index,
+					map_packets):
+				self.send(data)
+		self.map_offset = keyframe.map_offset
+		self.frames = self.demo.frames(keyframe.offset)
+		self.get_next_packet()
+
+class Client(object):
+	def __init__(self, peer, scheduler, version=None):
+		self.peer = peer
+		self.version = version
+		self.scheduler = scheduler
+		self.playback = None
+		self.spawned = False
+		self.spam_timer = None
+		self.playerid = None
+	def send(self, data):
+		if data[0] == STATE_DATA:
+			self.playerid = data[1]
+			self.spawned = False # a new map was loaded
+		self.peer.send(0, enet.Packet(data, enet.PACKET_FLAG_RELIABLE))
+	def chat(self, message):
+		self.peer.send(0, enet.Packet(chat_packet(message), enet.PACKET_FLAG_RELIABLE))
+	def spawn(self):
+		"""Creates the client's own player as a spectator"""
+		self.spawned = True
+		pkt = struct.pack("bbbbfff16s", 12, self.playerid, 1, -1, 255., 255., 1., b"") #create player
+		self.peer.send(0, enet.Packet(pkt, enet.PACKET_FLAG_RELIABLE))
+	def toggle_spam(self):
+		if self.spam_timer is None:
+			self.spam_timer = self.scheduler.call_at(time(), self.spam)
+		else:
+			self.stop_spam()
+	def stop_spam(self):
+		self.scheduler.cancel(self.spam_timer)
+		self.spam_timer = None
+	def spam(self):
+		if self.playback.pause_time == 0:
+			self.chat(str(self.playback.timedelta))
+		self.spam_timer = self.scheduler.call_at(time() + 1, self.spam)
+
+class LiveCursor(object):
+	"""frames() of a LiveDemo: stops at the newest frame, but can be
+	continued once more frames were written"""
+	def __init__(self, demo, position):
+		self.demo = demo
+		self.position = position
+	def __iter__(self):
+		return self
+	def __next__(self):
+		demo = self.demo
+		while True:
+			i = self.position - demo.base
+			if i < 0: # compacted away
+				self.position = demo.base
+				continue
+			if i >= len(demo.entries):
+				raise StopIteration
+			entry = demo.entries[i]
+			self.position += 1
+			if entry is not None:
+				return (self.position - 1,) + entry
+
+class LiveDemo(object):
+	"""A demo that is still being recorded, kept in memory and read like a
+	DemoReader. Positions are frame numbers.
+
+	compact() forgets what a reader that has got to some position can't
+	need anymore: earlier maps, and everything but map data and block edits
+	before the last keyframe."""
+	def __init__(self, aos_version):
+		self.aos_version = aos_version
+		self.index = IndexBuilder()
+		self.base = 0
+		self.entries = []
+		self.map_starts = []
+		self.keyframe_times = []
+		self.compacted = 0
+	@property
+	def keyframe_count(self):
+		return len(self.index.keyframes)
+	def write(self, timestamp, data):
+		position = self.base + len(self.entries)
+		if data[0] == MAP_START:
+			self.index.start_map(position)
+			self.map_starts.append(position)
+		elif self.index.is_due(timestamp):
+			self.index.add_keyframe(timestamp, position)
+			self.keyframe_times.append(timestamp)
+		self.entries.append((timestamp, data))
+		self.index.feed(data)
+	def start_position(self):
+		return self.base
+	def frames(self, position=None):
+		return LiveCursor(self, self.base if position is None else position)
+	def keyframe(self, index):
+		return self.index.keyframes[index]
+	def find_keyframe(self, timestamp):
+		index = bisect_right(self.keyframe_times, timestamp) - 1
+		if index < 0:
+			return -1, None
+		return index, self.index.keyframes[index]
+	def snapshot(self, index):
+		return unpack_snapshot(self.index.snapshots[index])
+	def compact(self, position):
+		map_start = None
+		while self.map_starts and self.map_starts[0] <= position:
+			map_start = self.map_starts.pop(0)
+		if map_start is not None and map_start > self.base:
+			del self.entries[:map_start - self.base]
+			self.base = map_start
+			keyframes = self.index.keyframes
+			old = 0
+			while old < len(keyframes) and keyframes[old].offset < map_start:
+				old += 1
+			del keyframes[:old], self.index.snapshots[:old]
+			del self.keyframe_times[:old]
+		index = bisect_right([keyframe.offset for keyframe in
+			self.index.keyframes], position) - 1
+		if index < 0:
+			return
+		end = self.index.keyframes[index].offset - self.base
+		entries = self.entries
+		for i in range(max(self.compacted - self.base, 0), end):
+			entry = entries[i]
+			if entry is not None and entry[1][0] not in CATCH_UP_PACKETS:
+				entries[i] = None
+		self.compacted = self.base + end
+
+class Relay(object):
+	"""Serves the game a recorder receives to viewers on host, delay
+	seconds behind. Call write() for every packet and service() and
+	timeout() from the network loop."""
+	def __init__(self, host, aos_version, delay=RELAY_DELAY):
+		self.host = host
+		self.aos_version = aos_version
+		self.delay = delay
+		self.scheduler = Scheduler()
+		self.demo = LiveDemo(aos_version)
+		self.playback = None
+		self.clients = {}
+		self.waiting = []
+		self.client_id = 0
+		self.writes = 0
+	def write(self, timestamp, data):
+		self.demo.write(timestamp, data)
+		if self.playback is None:
+			self.playback = Playback(self.demo, self.scheduler,
+				time() - timestamp + self.delay)
+			for cl in self.waiting:
+				self.playback.attach(cl)
+			del self.waiting[:]
+		elif self.playback.finished:
+			self.playback.resume()
+		self.writes += 1
+		if self.writes % COMPACT_INTERVAL == 0:
+			self.demo.compact(self.playback.offset)
+	def timeout(self):
+		return self.scheduler.timeout(time(), RELAY_POLL)
+	def service(self):
+		self.scheduler.run(time())
+		while True:
+			try:
+				event = self.host.service(0)
+			except IOError:
+				break
+			# pyenet returns an event of type NONE when nothing is pending
+			if event is None or event.type == enet.EVENT_TYPE_NONE:
+				break
+			if event.type == enet.EVENT_TYPE_CONNECT:
+				if event.peer.eventData & 0xff != self.aos_version:
+					event.peer.disconnect_now(3) #ERROR_WRONG_VERSION
+					continue
+				event.peer.data = bytes(str(self.client_id), 'utf-8')
+				self.client_id += 1
+				cl = self.clients[event.peer.data] = Client(event.peer,
+					self.scheduler, self.aos_version)
+				if self.playback is None:
+					self.waiting.append(cl)
+				else:
+					self.playback.attach(cl)
+			elif event.type == enet.EVENT_TYPE_DISCONNECT:
+				cl = self.clients.pop(event.peer.data, None)
+				if cl is None:
+					continue
+				if cl in self.waiting:
+					self.waiting.remove(cl)
+				else:
+					self.playback.detach(cl)
+			elif event.type == enet.EVENT_TYPE_RECEIVE:
+				cl = self.clients.get(event.peer.data)
+				if cl is not None and not cl.spawned and cl.playerid is not None:
+					cl.spawn()
+	def close(self):
+		for cl in self.clients.values():
+			cl.peer.disconnect(0) #ERROR_UNDEFINED
+		self.host.flush()
@@ -0,0 +1,565 @@
+#!/usr/bin/env python3
+"""
+Rebuilds the game world from a demo without a client.
+
+	from demostate import DemoState
+	state = DemoState('match.demo')
+	for snapshot in state.snapshots([60, 120, 754]):
+		print(snapshot.time, len(snapshot.players), snapshot.scores)
+		state.world.write_vxl('minute-%d.vxl' % (snapshot.time // 60))
+
+DemoState applies map transfers, block edits, player positions, kills and
+team changes to an in-memory world while stepping through the demo once,
+so asking for many snapshots costs a single linear pass. Snapshots copy the
+player table, but the world is shared and keeps changing: read or save it
+before stepping further, or copy() it.
+
+As a script it prints the players at the given times and can save the map
+as it was at each of them.
+"""
+
+import struct
+import zlib
+from array import array
+from collections import namedtuple
+from aosdemo import (DemoReader, map_name, WORLD_UPDATE, SET_COLOR,
+	EXISTING_PLAYER, CREATE_PLAYER, BLOCK_ACTION, BLOCK_LINE, STATE_DATA,
+	KILL_ACTION, MAP_START, MAP_CHUNK, PLAYER_LEFT, INTEL_CAPTURE,
+	CHANGE_TEAM, CHANGE_WEAPON, SET_TOOL)
+from demoanalysis import (decode_block, decode_block_line, decode_kill,
+	decode_string, BUILD_BLOCK, DESTROY_BLOCK, SPADE_DESTROY, GRENADE_DESTROY)
+
+MAP_X = MAP_Y = 512
+MAP_Z = 64
+FULL_COLUMN = (1 << MAP_Z) - 1
+DEFAULT_COLOR = 0x674028 # pyspades' color for solid voxels without one
+SHADE = 0x7f << 24 # fourth byte of every color written to a vxl
+MAX_LINE_LENGTH = 64
+GROUND_Z = 62 # blocks this deep are attached to the ground
+MAP_CHUNK_SIZE = 8192
+
+Snapshot = namedtuple('Snapshot', 'time map_name players scores kills')
+
+def _first_set(mask, z):
+	"""Returns the first z' >= z with bit z' of mask set, or MAP_Z"""
+	mask >>= z
+	if mask == 0:
+		return MAP_Z
+	return z + (mask & -mask).bit_length() - 1
+
+def _first_clear(mask, z):
+	"""Returns the first z' >= z with bit z' of mask clear"""
+	mask = ~(mask >> z)
+	return min(z + (mask & -mask).bit_length() - 1, MAP_Z)
+
+def cube_line(x1, y1, z1, x2, y2, z2):
+	"""Returns the blocks of a BlockLine, walked like the client does"""
+	dx, dy, dz = x2 - x1, y2 - y1, z2 - z1
+	ixi = -1 if dx < 0 else 1
+	iyi = -1 if dy < 0 else 1
+	izi = -1 if dz < 0 else 1
+	adx, ady, adz = abs(dx), abs(dy), abs(dz)
+	far = 0x3fffffff // MAP_X
+	if adx >= ady and adx >= adz:
+		dxi = 1024
+		dyi = adx * 1024 // ady if dy else far
+		dzi = adx * 1024 // adz if dz else far
+	elif ady >= adz:
+		dyi = 1024
+		dxi = ady * 1024 // adx if dx else far
+		dzi = ady * 1024 // adz if dz else far
+	else:
+		dzi = 1024
+		dxi = adz * 1024 // adx if dx else far
+		dyi = adz * 1024 // ady if dy else far
+	ex = dxi - dxi // 2 if ixi >= 0 else dxi // 2
+	ey = dyi - dyi // 2 if iyi >= 0 else dyi // 2
+	ez = dzi - dzi // 2 if izi >= 0 else dzi // 2
+	x, y, z = x1, y1, z1
+	blocks = []
+	while True:
+		blocks.append((x, y, z))
+		if len(blocks) > MAX_LINE_LENGTH or (x, y, z) == (x2, y2, z2):
+			return blocks
+		if ez <= ex and ez <= ey:
+			z += izi
+			if not 0 <= z < MAP_Z:
+				return blocks
+			ez += dzi
+		elif ex < ey:
+			x += ixi
+			if not 0 <= x < MAP_X:
+				return blocks
+			ex += dxi
+		else:
+			y += iyi
+			if not 0 <= y < MAP_Y:
+				return blocks
+			ey += dyi
+
+class World(object):
+	"""Voxel map kept as one solid bit mask per column plus a color per voxel.
+
+	Voxels are indexed (x << 15) | (y << 6) | z, columns (x << 9) | y."""
+	def __init__(self):
+		self.columns = [FULL_COLUMN] * (MAP_X * MAP_Y)
+		self.colors = array('I', [DEFAULT_COLOR]) * (MAP_X * MAP_Y * MAP_Z)
+
+	def copy(self):
+		world = World.__new__(World)
+		world.columns = self.columns[:]
+		world.colors = array('I', self.colors)
+		return world
+
+	def is_solid(self, x, y, z):
+		if not (0 <= x < MAP_X and 0 <= y < MAP_Y and 0 <= z < MAP_Z):
+			return False
+		return (self.columns[(x << 9) | y] >> z) & 1 == 1
+
+	def get_color(self, x, y, z):
+		"""Returns the 0xRRGGBB color of a solid voxel, None for air"""
+		if not self.is_solid(x, y, z):
+			return None
+		return self.colors[(x << 15) | (y << 6) | z] & 0xffffff
+
+	def set_block(self, x, y, z, color):
+		if not (0 <= x < MAP_X and 0 <= y < MAP_Y and 0 <= z < MAP_Z):
+			return
+		self.columns[(x << 9) | y] |= 1 << z
+		self.colors[(x << 15) | (y << 6) | z] = color & 0xffffff
+
+	def remove_block(self, x, y, z):
+		if not (0 <= x < MAP_X and 0 <= y < MAP_Y and 0 <= z < GROUND_Z):
+			return False
+		column = (x << 9) | y
+		if not (self.columns[column] >> z) & 1:
+			return False
+		self.columns[column] &= ~(1 << z)
+		return True
+
+	def remove_floating(self, x, y, z):
+		"""Removes the blocks connected to x, y, z if none of them reaches
+		the ground, like clients do after a block is destroyed. Returns how
+		many blocks fell."""
+		if not self.is_solid(x, y, z):
+			return 0
+		columns = self.columns
+		start = (x << 15) | (y << 6) | z
+		seen = {start}
+		stack = [start]
+		while stack:
+			node = stack.pop()
+			z = node & 63
+			if z >= GROUND_Z:
+				return 0
+			x = node >> 15
+			y = (node >> 6) & 511
+			# pushed last is searched first: head for the ground
+			for nx, ny, nz in ((x, y, z - 1), (x - 1, y, z), (x + 1, y, z),
+					(x, y - 1, z), (x, y + 1, z), (x, y, z + 1)):
+				if (0 <= nx < MAP_X and 0 <= ny < MAP_Y and nz >= 0 and
+						(columns[(nx << 9) | ny] >> nz) & 1):
+					neighbour = (nx << 15) | (ny << 6) | nz
+					if neighbour not in seen:
+						seen.add(neighbour)
+						stack.append(neighbour)
+		for node in seen:
+			columns[node >> 15 << 9 | (node >> 6) & 511] &= ~(1 << (node & 63))
+		return len(seen)
+
+	def destroy(self, blocks):
+		"""Removes blocks and everything that loses its connection to the
+		ground because of it. Returns how many blocks were removed."""
+		removed = [block for block in blocks if self.remove_block(*block)]
+		count = len(removed)
+		for x, y, z in removed:
+			for nx, ny, nz in ((x - 1, y, z), (x + 1, y, z), (x, y - 1, z),
+					(x, y + 1, z), (x, y, z - 1), (x, y, z + 1)):
+				count += self.remove_floating(nx, ny, nz)
+		return count
+
+	def load_vxl(self, data):
+		"""Replaces the world with a vxl map"""
+		columns = self.columns
+		colors = self.colors
+		colors[:] = array('I', [DEFAULT_COLOR]) * len(colors)
+		unpack_from = struct.unpack_from
+		pos = 0
+		for y in range(MAP_Y):
+			for x in range(MAP_X):
+				column = (x << 9) | y
+				base = column << 6
+				mask = FULL_COLUMN
+				z = 0
+				while True:
+					span, top_start, top_end, air_start = data[pos:pos + 4]
+					mask &= ~((1 << top_start) - (1 << z))
+					top_length = top_end - top_start + 1
+					colors[base + top_start:base + top_end + 1] = array('I',
+						unpack_from('<%dI' % top_length, data, pos + 4))
+					if span == 0:
+						pos += 4 * (top_length + 1)
+						break
+					bottom_length = span - 1 - top_length
+					pos += span * 4
+					z = data[pos + 3]
+					colors[base + z - bottom_length:base + z] = array('I',
+						unpack_from('<%dI' % bottom_length, data,
+						pos - bottom_length * 4))
+				columns[column] = mask
+
+	def surface(self, x, y):
+		"""Returns the mask of solid voxels in a column that touch air or
+		the sky, which are the ones a vxl stores colors for"""
+		columns = self.columns
+		solid = columns[(x << 9) | y]
+		covered = solid << 1 & (solid >> 1 | 1 << (MAP_Z - 1))
+		if x > 0:
+			covered &= columns[((x - 1) << 9) | y]
+		if x < MAP_X - 1:
+			covered &= columns[((x + 1) << 9) | y]
+		if y > 0:
+			covered &= columns[(x << 9) | (y - 1)]
+		if y < MAP_Y - 1:
+			covered &= columns[(x << 9) | (y + 1)]
+		return solid & ~covered
+
+	def to_vxl(self):
+		out = bytearray()
+		colors = self.colors
+		columns = self.columns
+		for y in range(MAP_Y):
+			for x in range(MAP_X):
+				column = (x << 9) | y
+				base = column << 6
+				solid = columns[column]
+				surface = self.surface(x, y)
+				hidden = solid & ~surface
+				z = 0
+				while z < MAP_Z:
+					air_start = z
+					top_start = z = _first_set(solid, z)
+					top_end = z = _first_clear(surface, z)
+					bottom_start = z = _first_clear(hidden, z)
+					end = _first_clear(surface, z)
+					if end != MAP_Z:
+						z = end
+					color_list = ([colors[base + i] & 0xffffff | SHADE
+						for i in range(top_start, top_end)] +
+						[colors[base + i] & 0xffffff | SHADE
+						for i in range(bottom_start, z)])
+					if z == MAP_Z:
+						span = 0
+					else:
+						span = len(color_list) + 1
+					out += struct.pack('<4B%dI' % len(color_list), span,
+						top_start & 0xff, (top_end - 1) & 0xff, air_start,
+						*color_list)
+		return bytes(out)
+
+	def write_vxl(self, path):
+		with open(path, 'wb') as fh:
+			fh.write(self.to_vxl())
+
+class PlayerState(object):
+	__slots__ = ('name', 'team', 'weapon', 'tool', 'color', 'kills',
+		'deaths', 'alive', 'position', 'orientation')
+	def __init__(self, name=None, team=-1, weapon=0):
+		self.name = name
+		self.team = team
+		self.weapon = weapon
+		self.tool = 0
+		self.color = DEFAULT_COLOR
+		self.kills = self.deaths = 0
+		self.alive = False
+		self.position = self.orientation = (0.0, 0.0, 0.0)
+	def copy(self):
+		player = PlayerState.__new__(PlayerState)
+		for name in self.__slots__:
+			setattr(player, name, getattr(self, name))
+		return player
+	def __repr__(self):
+		return "<PlayerState %r team %d at %.1f %.1f %.1f>" % ((self.name,
+			self.team) + self.position)
+
+class DemoState(object):
+	"""The world of a demo at the current time, advanced with step().
+	demo is a path or an open DemoReader (which is left open on close()),
+	position where to start reading, the default is the first frame."""
+	def __init__(self, demo, position=None):
+		self.own_demo = isinstance(demo, str)
+		if self.own_demo:
+			demo = DemoReader(demo, rebuild=False)
+		self.demo = demo
+		self.frames = demo.frames(position)
+		self.pending = None
+		self.time = 0.0
+		self.world = World()
+		self.map_name = None
+		self.map_data = self.map_chunks = None
+		self.map_loaded = False
+		self.state_data = None
+		self.players = {}
+		self.scores = [0, 0]
+		self.kills = []
+		self.handlers = {
+			MAP_START: self.on_map_start,
+			MAP_CHUNK: self.on_map_chunk,
+			STATE_DATA: self.on_state_data,
+			BLOCK_ACTION: self.on_block_action,
+			BLOCK_LINE: self.on_block_line,
+			WORLD_UPDATE: self.on_world_update,
+			EXISTING_PLAYER: self.on_existing_player,
+			CREATE_PLAYER: self.on_create_player,
+			PLAYER_LEFT: self.on_player_left,
+			KILL_ACTION: self.on_kill,
+			SET_COLOR: self.on_set_color,
+			SET_TOOL: self.on_set_tool,
+			CHANGE_TEAM: self.on_change_team,
+			CHANGE_WEAPON: self.on_change_weapon,
+			INTEL_CAPTURE: self.on_intel_capture,
+		}
+
+	def close(self):
+		self.frames = iter(())
+		if self.own_demo:
+			self.demo.close()
+
+	def step(self, timestamp):
+		"""Applies every packet up to and including timestamp"""
+		handlers = self.handlers
+		frame = self.pending
+		self.pending = None
+		while True:
+			if frame is None:
+				frame = next(self.frames, None)
+				if frame is None:
+					break
+			position, frame_time, data = frame
+			if frame_time > timestamp:
+				self.pending = frame
+				break
+			handler = handlers.get(data[0])
+			if handler is not None:
+				try:
+					handler(frame_time, data)
+				except (struct.error, ValueError, IndexError):
+					pass # malformed packet
+			frame = None
+		self.time = max(self.time, timestamp)
+
+	def step_to(self, position):
+		"""Applies every packet before the frame at position"""
+		handlers = self.handlers
+		frame = self.pending
+		self.pending = None
+		while True:
+			if frame is None:
+				frame = next(self.frames, None)
+				if frame is None:
+					break
+			if frame[0] >= position:
+				self.pending = frame
+				break
+			handler = handlers.get(frame[2][0])
+			if handler is not None:
+				try:
+					handler(frame[1], frame[2])
+				except (struct.error, ValueError, IndexError):
+					pass # malformed packet
+			self.time = max(self.time, frame[1])
+			frame = None
+
+	def snapshot(self):
+		"""Returns the players and scores now and the kills since the last
+		snapshot"""
+		kills = self.kills
+		self.kills = []
+		players = dict((player_id, player.copy())
+			for player_id, player in self.players.items())
+		return Snapshot(self.time, self.map_name, players, tuple(self.scores),
+			kills)
+
+	def snapshots(self, times):
+		"""Yields a Snapshot for every time, in ascending order"""
+		for timestamp in sorted(times):
+			self.step(timestamp)
+			yield self.snapshot()
+
+	def map_packets(self):
+		"""Returns MapStart, MapChunk and StateData packets that load the
+		world as it is now into a 0.75 client, None without a loaded map.
+		0.76 clients verify maps by checksum, so the recorded map must be
+		sent to them instead."""
+		if not self.map_loaded or self.state_data is None:
+			return None
+		data = zlib.compress(self.world.to_vxl())
+		packets = [struct.pack('<BI', MAP_START, len(data))]
+		for i in range(0, len(data), MAP_CHUNK_SIZE):
+			packets.append(bytes([MAP_CHUNK]) + data[i:i + MAP_CHUNK_SIZE])
+		state_data = bytearray(self.state_data)
+		if len(state_data) >= 34 and state_data[31] == 0: # ctf
+			state_data[32:34] = bytes(min(score, 255) for score in self.scores)
+		packets.append(bytes(state_data))
+		return packets
+
+	def player(self, player_id):
+		player = self.players.get(player_id)
+		if player is None:
+			player = self.players[player_id] = PlayerState()
+		return player
+
+	def on_map_start(self, timestamp, data):
+		self.map_name = map_name(data)
+		self.map_data = zlib.decompressobj()
+		self.map_chunks = []
+		self.map_loaded = False
+		self.state_data = None
+		self.players.clear()
+
+	def on_map_chunk(self, timestamp, data):
+		if self.map_data is not None:
+			self.map_chunks.append(self.map_data.decompress(bytes(data[1:])))
+
+	def on_state_data(self, timestamp, data):
+		if self.map_data is not None:
+			self.map_chunks.append(self.map_data.flush())
+			try:
+				self.world.load_vxl(b''.join(self.map_chunks))
+				self.map_loaded = True
+			except (ValueError, IndexError, struct.error):
+				self.world = World() # incomplete map
+			self.map_data = self.map_chunks = None
+		self.state_data = data
+		if len(data) >= 34 and data[31] == 0: # ctf
+			self.scores = [data[32], data[33]]
+
+	def on_block_action(self, timestamp, data):
+		event = decode_block(timestamp, data)
+		x, y, z = event.x, event.y, event.z
+		if event.action == BUILD_BLOCK:
+			self.world.set_block(x, y, z, self.player(event.player_id).color)
+		elif event.action == DESTROY_BLOCK:
+			self.world.destroy([(x, y, z)])
+		elif event.action == SPADE_DESTROY:
+			self.world.destroy([(x, y, z - 1), (x, y, z), (x, y, z + 1)])
+		elif event.action == GRENADE_DESTROY:
+			self.world.destroy([(x + i, y + j, z + k) for i in (-1, 0, 1)
+				for j in (-1, 0, 1) for k in (-1, 0, 1)])
+
+	def on_block_line(self, timestamp, data):
+		event = decode_block_line(timestamp, data)
+		color = self.player(event.player_id).color
+		for x, y, z in cube_line(event.x1, event.y1, event.z1,
+				event.x2, event.y2, event.z2):
+			self.world.set_block(x, y, z, color)
+
+	def on_world_update(self, timestamp, data):
+		players = self.players
+		if self.demo.aos_version == 3:
+			for player_id, values in enumerate(struct.iter_unpack('<6f',
+					data[1:1 + 24 * 32])):
+				player = players.get(player_id)
+				if player is not None:
+					player.position = values[:3]
+					player.orientation = values[3:]
+		else:
+			end = 1 + (len(data) - 1) // 25 * 25
+			for values in struct.iter_unpack('<B6f', data[1:end]):
+				player = players.get(values[0])
+				if player is not None:
+					player.position = values[1:4]
+					player.orientation = values[4:]
+
+	def on_existing_player(self, timestamp, data):
+		player_id, team, weapon, tool, kills = struct.unpack_from('<BbBBI',
+			data, 1)
+		player = self.player(player_id)
+		player.name = decode_string(data[12:])
+		player.team, player.weapon, player.tool = team, weapon, tool
+		player.kills = kills
+		player.color = int.from_bytes(data[9:12], 'little')
+		player.alive = team >= 0
+
+	def on_create_player(self, timestamp, data):
+		player_id, weapon, team, x, y, z = struct.unpack_from('<BBb3f', data, 1)
+		player = self.player(player_id)
+		player.name = decode_string(data[16:])
+		player.team, player.weapon = team, weapon
+		player.position = (x, y, z)
+		player.alive = True
+
+	def on_player_left(self, timestamp, data):
+		self.players.pop(data[1], None)
+
+	def on_kill(self, timestamp, data):
+		event = decode_kill(timestamp, data)
+		self.kills.append(event)
+		victim = self.player(event.victim)
+		victim.alive = False
+		victim.deaths += 1
+		if event.killer != event.victim:
+			self.player(event.killer).kills += 1
+
+	def on_set_color(self, timestamp, data):
+		self.player(data[1]).color = int.from_bytes(data[2:5], 'little')
+
+	def on_set_tool(self, timestamp, data):
+		self.player(data[1]).tool = data[2]
+
+	def on_change_team(self, timestamp, data):
+		self.player(data[1]).team = struct.unpack_from('b', data, 2)[0]
+
+	def on_change_weapon(self, timestamp, data):
+		self.player(data[1]).weapon = data[2]
+
+	def on_intel_capture(self, timestamp, data):
+		team = self.player(data[1]).team
+		if team in (0, 1):
+			self.scores[team] += 1
+
+def synthesize_map(demo, index):
+	"""Returns packets that load the map of keyframe index of demo with all
+	block edits before the keyframe applied, so a client can skip them, or
+	None if that isn't possible (0.76 demos, incomplete maps)"""
+	if demo.aos_version != 3:
+		return None
+	keyframe = demo.keyframe(index)
+	state = DemoState(demo, keyframe.map_offset)
+	try:
+		state.step_to(keyframe.offset)
+		return state.map_packets()
+	finally:
+		state.close()
+
+def parse_time(text):
+	"""Accepts seconds or [hh:]mm:ss"""
+	seconds = 0.0
+	for part in text.split(':'):
+		seconds = seconds * 60 + float(part)
+	return seconds
+
+if __name__ == '__main__':
+	import argparse
+	parser  = argparse.ArgumentParser(description="Show the state of a demo at given times")
+	parser.add_argument('file', help="Demo to read")
+	parser.add_argument('times', nargs='+', type=parse_time, help="Times as seconds or mm:ss")
+	parser.add_argument('--vxl', metavar='PREFIX', help="Also save the map at every time as PREFIX-SECONDS.vxl")
+	args = parser.parse_args()
+	state = DemoState(args.file)
+	for snapshot in state.snapshots(args.times):
+		print("%d:%05.2f %s, score %d:%d" % (snapshot.time // 60,
+			snapshot.time % 60, snapshot.map_name or "unnamed map",
+			snapshot.scores[0], snapshot.scores[1]))
+		for kill in snapshot.kills:
+			print("  %.2f %d killed %d" % (kill.time, kill.killer, kill.victim))
+		for player_id in sorted(snapshot.players):
+			player = snapshot.players[player_id]
+			print("  %3d %-16s team %2d %s %6.1f %6.1f %6.1f, %d kills %d deaths" % (
+				player_id, player.name or "?", player.team,
+				"alive" if player.alive else "dead ", player.position[0],
+				player.position[1], player.position[2], player.kills,
+				player.deaths))
+		if args.vxl and state.map_loaded:
+			state.world.write_vxl("%s-%d.vxl" % (args.vxl, snapshot.time))
+	state.close()
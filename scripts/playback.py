@@ -1,123 +1,204 @@
 #!/usr/bin/env python3
-""" 
-Original script and description can be found here: 
+"""
+Original script and description can be found here:
 https://github.com/BR-/aos_replay
 This version contains quick fixes for newer versions of python and enet
+
+With --cinema, the demo is decoded once and every packet is sent to all
+connected clients, late joiners catch up from the nearest keyframe.
+
+Packets are sent from a timer heap: the server blocks in host.service()
+until the next packet is due, so an idle server uses no CPU. The serving
+logic lives in demoserver.py.
+
+Given a directory instead of a file, the server hosts every demo in it.
+Clients pick one with the chat commands 'demos' and 'play X', or connect
+with the demo's number from 'demos' in the upper bits of the connection
+data (version | number << 8). Open demos are shared by all their viewers
+and the last --cache of them stay open. With --cinema, a demo of the
+directory keeps playing while anyone watches it and starts over for the
+next viewer once everyone left.
+
+Chat commands: spawn, id X, time, pause, unpause, ff N, rw N (skip
+forward or back N seconds), speed X (0.25 to 16 times real time),
+demos [PAGE] and play X.
+
+With --synthesize-maps, clients that join late, skip ahead or --start far
+into a 0.75 demo get the map with every block edit up to that point already
+applied, one map transfer instead of all the edits since the map was
+loaded. Rebuilding a map stalls the server for a few seconds (the last few
+are cached), so it suits --cinema servers more than busy libraries.
 """
 
 import sys
 
-FILE_VERSION = 1
-
 import argparse
 parser  = argparse.ArgumentParser(description="Playback some gameplay")
-parser.add_argument('file', default='replay.demo', help="File to read from")
+parser.add_argument('file', default='replay.demo', help="File to read from, or a directory of demos to serve")
 parser.add_argument('port', default=32887, type=int, help="The port to run on")
+parser.add_argument('--cinema', action='store_true', help="Play the demo once for all clients instead of once per client")
+parser.add_argument('--start', type=float, default=0, metavar='SECONDS', help="Start playing this far into the demo")
+parser.add_argument('--synthesize-maps', action='store_true', help="Send late joiners the map with its block edits applied (blocks the server while a map is rebuilt)")
+parser.add_argument('--cache', type=int, default=8, help="Demos of a directory to keep open when nobody watches them (default: 8)")
 args = parser.parse_args()
 
+import os
 import struct
-with open(args.file, "rb") as fh:
-	fmt = "BB"
-	fmtlen = struct.calcsize(fmt)
-	data = fh.read(fmtlen)
-	file_version, aos_version = struct.unpack(fmt, data)
-	if FILE_VERSION != file_version:
-		if FILE_VERSION < file_version:
-			print("This demo was recorded on a newer version of aos_replay.")
-		elif FILE_VERSION > file_version:
-			print("This demo was recorded on an older version of aos_replay.")
-		print("aos_replay version: %d" % FILE_VERSION)
-		print("Demo version: %d" % file_version)
+from aosdemo import DemoReader, DemoError, FILE_VERSION, SUPPORTED_VERSIONS
+from demoserver import DemoLibrary, Scheduler, Playback, Client, MIN_SPEED, MAX_SPEED, DEMO_EXTENSION
+if os.path.isdir(args.file):
+	library = DemoLibrary(args.file, args.cache)
+	if not library.names():
+		print("ERROR: no %s files in %s" % (DEMO_EXTENSION, args.file))
 		sys.exit(1)
-
-class Client(object):
-	def __init__(self, peer, fh, start_time):
-		self.peer = peer
-		self.fh = fh
-		self.fh.read(struct.calcsize("BB"))
-		self.start_time = start_time
-		self.pause_time = 0
-		self.get_next_packet()
-		self.spawned = False
-		self.spam_time = None
-		self.playerinfo = [[0,0] for _ in range(32)]
-		self.playerid = None
-	def get_next_packet(self):
-		fmt = "fH"
+	demo = None
+else:
+	library = None
+	with open(args.file, "rb") as fh:
+		fmt = "BB"
 		fmtlen = struct.calcsize(fmt)
-		meta = self.fh.read(fmtlen)
-		if len(meta) < fmtlen:
-			raise EOFError("replay file finished")
-		self.timedelta, size = struct.unpack(fmt, meta)
-		self.data = self.fh.read(size)
-		if self.data[0] == 15: # state data
-			self.playerid = self.data[1]
+		data = fh.read(fmtlen)
+		file_version, aos_version = struct.unpack(fmt, data)
+		if file_version not in SUPPORTED_VERSIONS:
+			if FILE_VERSION < file_version:
+				print("This demo was recorded on a newer version of aos_replay.")
+			elif FILE_VERSION > file_version:
+				print("This demo was recorded on an older version of aos_replay.")
+			print("aos_replay version: %d" % FILE_VERSION)
+			print("Demo version: %d" % file_version)
+			sys.exit(1)
+	demo = DemoReader(args.file)
+
+LIST_PAGE_SIZE = 8
+
+def watch(cl, name):
+	"""Moves cl to the demo called name (None without a library), shared
+	with everyone watching it in cinema mode. Returns False if the demo is
+	for another client version, raises DemoError if it can't be played."""
+	playback = cinemas.get(name) if args.cinema else None
+	if playback is None:
+		playback_demo = demo if library is None else library.acquire(name)
+		if playback_demo.aos_version != cl.version:
+			if library is not None:
+				library.release(name)
+			return False
+		playback = None
+		try:
+			playback = Playback(playback_demo, scheduler, time(), playback_finished, name)
+			playback.synthesize_maps = args.synthesize_maps
+			if args.start > 0:
+				playback.seek(args.start)
+		except EOFError:
+			# header only or truncated before the first frame
+			if playback is not None:
+				playback.stop()
+			if library is not None:
+				library.release(name)
+			raise DemoError("no frames to play")
+		if args.cinema:
+			cinemas[name] = playback
+	elif playback.demo.aos_version != cl.version:
+		return False
+	if cl.playback is playback:
+		return True # leaving would close the cinema it's about to join
+	if cl.playback is not None:
+		leave(cl)
+	playback.attach(cl)
+	return True
+
+def leave(cl):
+	playback = cl.playback
+	playback.detach(cl)
+	cl.playback = None
+	# a single demo cinema keeps running, a library one would keep its demo
+	# acquired past the --cache limit
+	if not playback.clients and (not args.cinema or library is not None):
+		close_playback(playback)
+
+def close_playback(playback):
+	playback.stop()
+	if cinemas.get(playback.name) is playback:
+		del cinemas[playback.name]
+	if library is not None:
+		library.release(playback.name)
+
+def playback_finished(playback):
+	for cl in playback.clients:
+		print(cl.peer.data, "finished playback")
+		cl.peer.disconnect(0) #ERROR_UNDEFINED
+		cl.stop_spam()
+		del clients[cl.peer.data]
+	close_playback(playback)
+
+def find_demo(text):
+	"""Returns the demo name for a number from 'demos' or a name"""
+	names = library.names()
+	try:
+		number = int(text)
+	except ValueError:
+		if not text.endswith(DEMO_EXTENSION):
+			text += DEMO_EXTENSION
+		return text if text in names else None
+	if 0 < number <= len(names):
+		return names[number - 1]
+	return None
 
 import enet
 from time import time
 host = enet.Host(enet.Address(bytes('0.0.0.0', 'utf-8'), args.port), 128, 1)
 host.compress_with_range_coder()
+scheduler = Scheduler()
 clients = {}
 client_id = 0
+cinemas = {}
 while True:
-	for cl in list(clients.values()):
-		if cl.pause_time > 0:
-			continue
-		if cl.spam_time is not None and cl.spam_time <= time():
-			pkt = struct.pack("bbb", 17, 35, 2) + str(cl.timedelta).encode('cp437', 'replace') #chat message
-			cl.peer.send(0, enet.Packet(pkt, enet.PACKET_FLAG_RELIABLE))
-			cl.spam_time = time() + 1
-		while cl.start_time + cl.timedelta <= time():
-			if cl.data[0] == 3: #input data
-				player, data = struct.unpack("xbb", cl.data)
-				cl.playerinfo[player][0] = data
-			elif cl.data[0] == 4: #weapon data
-				player, data = struct.unpack("xbb", cl.data)
-				cl.playerinfo[player][1] = data
-			cl.peer.send(0, enet.Packet(cl.data, enet.PACKET_FLAG_RELIABLE))
-			try:
-				cl.get_next_packet()
-			except EOFError:
-				print(cl.peer.data, "finished playback")
-				cl.peer.disconnect(0) #ERROR_UNDEFINED
-				cl.fh.close()
-				del clients[cl.peer.data]
-				break
+	scheduler.run(time())
 	try:
-		event = host.service(0)
+		event = host.service(scheduler.timeout(time()))
 	except IOError:
 		continue
 	if event is None:
 		continue
 	elif event.type == enet.EVENT_TYPE_CONNECT:
-		if event.peer.eventData == aos_version:
-			event.peer.data = bytes(str(client_id), 'utf-8')
-			client_id += 1
-			clients[event.peer.data] = Client(event.peer, open(args.file, "rb"), time())
-			print("received client connection", event.peer.data)
+		event.peer.data = bytes(str(client_id), 'utf-8')
+		client_id += 1
+		cl = Client(event.peer, scheduler, event.peer.eventData & 0xff)
+		name = None
+		if library is not None:
+			names = library.names()
+			name = find_demo(str(event.peer.eventData >> 8)) or (names[0] if names else None)
+		try:
+			if library is not None and name is None:
+				raise DemoError("no %s files left in %s" % (DEMO_EXTENSION, args.file))
+			watching = watch(cl, name)
+		except (KeyError, DemoError) as e:
+			print("could not open %s: %s" % (name, e))
+			event.peer.disconnect_now(0) #ERROR_UNDEFINED
 		else:
-			print("WRONG CLIENT VERSION: replay is version %s and client was version %s" % (aos_version, event.peer.eventData))
-			event.peer.disconnect_now(3) #ERROR_WRONG_VERSION
+			if watching:
+				clients[event.peer.data] = cl
+				print("received client connection", event.peer.data, name or "")
+			else:
+				print("WRONG CLIENT VERSION: client was version %s" % cl.version)
+				event.peer.disconnect_now(3) #ERROR_WRONG_VERSION
 	elif event.type == enet.EVENT_TYPE_DISCONNECT:
 		if event.peer.data in clients:
-			clients[event.peer.data].fh.close()
-			del clients[event.peer.data]
+			cl = clients.pop(event.peer.data)
+			cl.stop_spam()
+			leave(cl)
 		print("lost client connection", event.peer.data)
 	elif event.type == enet.EVENT_TYPE_RECEIVE:
 		cl = clients[event.peer.data]
+		playback = cl.playback
 		if not cl.spawned and cl.playerid is not None:
-			cl.spawned = True
-			pkt = struct.pack("bbbbfff16s", 12, cl.playerid, 1, -1, 255., 255., 1., b"")
-			event.peer.send(0, enet.Packet(pkt, enet.PACKET_FLAG_RELIABLE))
+			cl.spawn()
 		elif event.packet.data[0] == 17:
 			chat = event.packet.data[3:-1].decode('cp437', 'replace')
 			if chat == "spawn":
 				if cl.playerid is None:
 					print("error: could not figure out player id, guessing! use the command 'id X' to fix")
 					cl.playerid = 0
-				cl.spawned = True
-				pkt = struct.pack("bbbbfff16s", 12, cl.playerid, 1, -1, 255., 255., 1., "asd") #create player
-				event.peer.send(0, enet.Packet(pkt, enet.PACKET_FLAG_RELIABLE))
+				cl.spawn()
 			elif chat[:3] == "id ":
 				try:
 					playerid = int(chat[3:])
@@ -125,30 +206,59 @@ while True:
 					pass
 				else:
 					cl.playerid = playerid
-			elif chat == "pause" and cl.pause_time == 0:
-				cl.pause_time = time()
+			elif chat == "time":
+				cl.toggle_spam()
+			elif library is not None and (chat == "demos" or chat[:6] == "demos "):
+				names = library.names()
+				try:
+					page = int(chat[6:] or 1)
+				except ValueError:
+					page = 1
+				first = (page - 1) * LIST_PAGE_SIZE
+				for number, name in enumerate(names[first:first + LIST_PAGE_SIZE], first + 1):
+					cl.chat("%d: %s" % (number, name))
+				cl.chat("page %d of %d, 'play X' to watch" % (page, (len(names) - 1) // LIST_PAGE_SIZE + 1))
+			elif library is not None and chat[:5] == "play ":
+				name = find_demo(chat[5:].strip())
+				try:
+					if name is None:
+						cl.chat("no such demo, see 'demos'")
+					elif not watch(cl, name):
+						cl.chat("%s was recorded for another client version" % name)
+				except (KeyError, DemoError):
+					cl.chat("could not open %s" % name)
+			elif args.cinema and (chat in ("pause", "unpause") or chat[:3] in ("ff ", "rw ") or chat[:6] == "speed "):
+				cl.chat("the timeline is shared in cinema mode")
+			elif chat == "pause" and playback.pause_time == 0:
+				playback.pause()
 				for i in range(32):
 					pkt = struct.pack("bbb", 3, i, 0) #input data
 					event.peer.send(0, enet.Packet(pkt, enet.PACKET_FLAG_RELIABLE))
 					pkt = struct.pack("bbb", 4, i, 0) #weapon data
 					event.peer.send(0, enet.Packet(pkt, enet.PACKET_FLAG_RELIABLE))
-			elif chat == "unpause" and cl.pause_time > 0:
-				cl.start_time += time() - cl.pause_time
-				cl.pause_time = 0
+			elif chat == "unpause" and playback.pause_time > 0:
+				playback.unpause()
 				for i in range(32):
-					pkt = struct.pack("bbb", 3, i, cl.playerinfo[i][0]) #input data
+					pkt = struct.pack("bbb", 3, i, playback.playerinfo[i][0]) #input data
 					event.peer.send(0, enet.Packet(pkt, enet.PACKET_FLAG_RELIABLE))
-					pkt = struct.pack("bbb", 4, i, cl.playerinfo[i][1]) #weapon data
+					pkt = struct.pack("bbb", 4, i, playback.playerinfo[i][1]) #weapon data
 					event.peer.send(0, enet.Packet(pkt, enet.PACKET_FLAG_RELIABLE))
-			elif chat[:3] == "ff ":
+			elif chat[:3] in ("ff ", "rw "):
 				try:
 					skip = int(chat[3:])
 				except:
 					pass
 				else:
-					cl.start_time = cl.start_time - skip
-			elif chat == "time":
-				if cl.spam_time is None:
-					cl.spam_time = 0
+					if chat[:3] == "rw ":
+						skip = -skip
+					playback.seek(playback.demo_time() + skip)
+			elif chat[:6] == "speed ":
+				try:
+					speed = float(chat[6:])
+				except:
+					pass
 				else:
-					cl.spam_time = None
\ No newline at end of file
+					if MIN_SPEED <= speed <= MAX_SPEED:
+						playback.set_speed(speed)
+					else:
+						cl.chat("speed must be between %g and %g" % (MIN_SPEED, MAX_SPEED))
@@ -3,72 +3,82 @@
 Original script and description can be found here: 
 https://github.com/BR-/aos_replay
 This version contains quick fixes for newer versions of python and enet
-"""
 
-FILE_VERSION = 1
+With --relay-port, the recorder also serves the game to spectators, a few
+seconds behind, so they don't take slots and bandwidth on the game server.
+"""
 
 import argparse
 parser  = argparse.ArgumentParser(description="Record some gameplay")
 parser.add_argument('ip', help="The server's IP")
 parser.add_argument('port', type=int, nargs='?', default=-1, help="The server's port (default: 32887)")
 parser.add_argument('file', help="File to save to")
+parser.add_argument('--flush-size', type=int, default=256, help="Buffer this many KiB before writing to disk (default: 256)")
+parser.add_argument('--flush-interval', type=float, default=2.0, help="Write buffered data at least every this many seconds (default: 2)")
+parser.add_argument('--split', action='store_true', help="Start a new file for every map and list them in a manifest next to FILE")
+parser.add_argument('--compress', choices=['zlib', 'lzma'], help="Compress the demo while recording")
+parser.add_argument('--relay-port', type=int, help="Serve the game to spectators on this port while recording")
+parser.add_argument('--relay-delay', type=float, default=10.0, help="Seconds the relay stays behind the game (default: 10)")
+parser.add_argument('--relay-peers', type=int, default=64, help="Spectators the relay accepts (default: 64)")
 versiongroup = parser.add_mutually_exclusive_group()
 versiongroup.add_argument('-75', action='store_const', dest='version', const=3, help="Use if the server is 0.75 (default)")
 versiongroup.add_argument('-76', action='store_const', dest='version', const=4, help="Use if the server is 0.76")
 parser.set_defaults(version=3)
 args = parser.parse_args()
 
-do_aos_conversion = args.ip.startswith("aos://")
-if do_aos_conversion:
-	args.ip = args.ip[6:]
+from aosdemo import DemoError, SegmentRecorder, parse_address
+try:
+	args.ip, args.port = parse_address(args.ip, args.port)
+except DemoError:
+	print("ERROR: AoS address not valid?")
+	import sys
+	sys.exit()
 
-if args.port == -1:
-	try:
-		ip, port = args.ip.rsplit(':', 1)
-		args.port = int(port)
-		args.ip = ip
-	except ValueError:
-		args.port = 32887
+import os
+import re
+import enet
+from time import monotonic
 
-if do_aos_conversion:
-	dec = int(args.ip)
-	ip = ""
-	for _ in range(4):
-		ip += str(dec % 256) + "."
-		dec //= 256
-	if dec != 0:
-		print("ERROR: AoS address not valid?")
-		import sys
-		sys.exit()
-	args.ip = ip[:-1]
+def path_for_segment(segment, map_name):
+	if not args.split:
+		return args.file
+	root, ext = os.path.splitext(args.file)
+	if map_name is not None:
+		return "%s-%03d-%s%s" % (root, segment, re.sub(r'[^\w.-]+', '_', map_name), ext)
+	return "%s-%03d%s" % (root, segment, ext)
 
-#TODO: fix race condition
-import os
-if os.path.exists(args.file):
-	i = 1
-	while os.path.exists(args.file + "-" + str(i)):
-		i += 1
-	args.file += "-" + str(i)
+def segment_closed(path, sink):
+	print('recording saved to %s:' % path, sink.stats())
 
-import struct
-import enet
-from time import time
+recorder = SegmentRecorder(path_for_segment, args.version, args.compress,
+	args.flush_size * 1024, args.flush_interval, on_close=segment_closed,
+	split=args.split, manifest_path=os.path.splitext(args.file)[0] + ".manifest.json" if args.split else None)
+relay = None
+if args.relay_port is not None:
+	from demoserver import Relay
+	relay_host = enet.Host(enet.Address(bytes('0.0.0.0', 'utf-8'), args.relay_port), args.relay_peers, 1)
+	relay_host.compress_with_range_coder()
+	relay = Relay(relay_host, args.version, args.relay_delay)
+	print('relaying to spectators on port %d, %g seconds behind' % (args.relay_port, args.relay_delay))
 con = enet.Host(None, 1, 1)
 con.compress_with_range_coder()
 print('Trying to connect to: ' + args.ip)
 peer = con.connect(enet.Address(bytes(args.ip, 'utf-8'), args.port), 1, args.version)
-with open(args.file, "wb") as fh:
-	fh.write(struct.pack('BB', FILE_VERSION, args.version))
+try:
 	while True:
 		try:
-			event = con.service(1000)
+			event = con.service(1000 if relay is None else relay.timeout())
 		except IOError:
 			continue
+		finally:
+			recorder.poll()
+			if relay is not None:
+				relay.service()
 		if event is None:
 			continue
 		elif event.type == enet.EVENT_TYPE_CONNECT:
 			print('connected to server')
-			start_time = time()
+			start_time = monotonic()
 		elif event.type == enet.EVENT_TYPE_DISCONNECT:
 			try:
 				reason = ["generic error", "banned", "kicked", "wrong version", "server is full"][event.data]
@@ -78,5 +88,11 @@ with open(args.file, "wb") as fh:
 			break
 		elif event.type == enet.EVENT_TYPE_RECEIVE:
 			#print(hex(ord(event.packet.data[0])))
-			fh.write(struct.pack('fH', time() - start_time, len(event.packet.data)))
-			fh.write(event.packet.data)
+			timestamp = monotonic() - start_time
+			recorder.write(timestamp, event.packet.data)
+			if relay is not None:
+				relay.write(timestamp, event.packet.data)
+finally:
+	recorder.close()
+	if relay is not None:
+		relay.close()
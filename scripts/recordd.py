@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Records a whole fleet of servers from one process.
+
+Every server gets its own ENet client host and all of them are serviced
+cooperatively from a single asyncio event loop. Recordings are split into
+one demo per map with a manifest per session, lost connections are retried,
+and per-connection packet and byte rates are logged and served as JSON on
+the optional status port.
+
+	recordd.py demos/ tdm=aos://16777343:32887 ctf=play.example.com:32888
+"""
+
+import argparse
+parser  = argparse.ArgumentParser(description="Record many servers at once")
+parser.add_argument('directory', help="Directory to save demos to")
+parser.add_argument('servers', nargs='+', metavar='NAME=ADDRESS', help="Servers to record, e.g. tdm=aos://16777343:32887")
+parser.add_argument('--flush-size', type=int, default=256, help="Buffer this many KiB before writing to disk (default: 256)")
+parser.add_argument('--flush-interval', type=float, default=2.0, help="Write buffered data at least every this many seconds (default: 2)")
+parser.add_argument('--compress', choices=['zlib', 'lzma'], help="Compress the demos while recording")
+parser.add_argument('--reconnect-delay', type=float, default=30.0, help="Seconds to wait before reconnecting to a server (default: 30)")
+parser.add_argument('--poll-interval', type=float, default=5.0, help="Milliseconds to sleep when no server has events (default: 5)")
+parser.add_argument('--rate-interval', type=float, default=60.0, help="Seconds between rate reports (default: 60)")
+parser.add_argument('--status-port', type=int, help="Serve per-connection rates as JSON on this TCP port")
+versiongroup = parser.add_mutually_exclusive_group()
+versiongroup.add_argument('-75', action='store_const', dest='version', const=3, help="Use if the servers are 0.75 (default)")
+versiongroup.add_argument('-76', action='store_const', dest='version', const=4, help="Use if the servers are 0.76")
+parser.set_defaults(version=3)
+args = parser.parse_args()
+
+import asyncio
+import json
+import os
+import re
+import sys
+import enet
+from time import monotonic, strftime, time
+from aosdemo import DemoError, SegmentRecorder, parse_address
+
+MAX_EVENTS = 256 # per server and service() call, so a busy one can't starve the rest
+DISCONNECT_REASONS = ["generic error", "banned", "kicked", "wrong version", "server is full"]
+
+class ServerRecording(object):
+	def __init__(self, name, ip, port):
+		self.name = name
+		self.ip = ip
+		self.port = port
+		self.host = self.peer = self.recorder = None
+		self.start_time = None
+		self.reconnect_at = 0.0
+		self.packets = self.bytes = 0
+		self.window_packets = self.window_bytes = 0
+		self.packet_rate = self.byte_rate = 0.0
+
+	def log(self, *message):
+		print("[%s]" % self.name, *message)
+
+	def connect(self):
+		self.log('trying to connect to: %s:%d' % (self.ip, self.port))
+		self.host = enet.Host(None, 1, 1)
+		self.host.compress_with_range_coder()
+		self.peer = self.host.connect(enet.Address(bytes(self.ip, 'utf-8'), self.port), 1, args.version)
+
+	def start_recording(self):
+		base = os.path.join(args.directory, "%s-%s" % (self.name, strftime('%Y%m%d-%H%M%S')))
+		def path_for_segment(segment, map_name):
+			if map_name is not None:
+				return "%s-%03d-%s.demo" % (base, segment, re.sub(r'[^\w.-]+', '_', map_name))
+			return "%s-%03d.demo" % (base, segment)
+		self.recorder = SegmentRecorder(path_for_segment, args.version, args.compress,
+			args.flush_size * 1024, args.flush_interval, on_close=self.segment_closed,
+			manifest_path=base + ".manifest.json")
+
+	def segment_closed(self, path, sink):
+		self.log('saved', path + ':', sink.stats())
+
+	def service(self):
+		"""Handles up to MAX_EVENTS pending events and returns how many there
+		were"""
+		count = 0
+		while self.host is not None and count < MAX_EVENTS:
+			try:
+				event = self.host.service(0)
+			except IOError:
+				break
+			# pyenet returns an event of type NONE when nothing is pending
+			if event is None or event.type == enet.EVENT_TYPE_NONE:
+				break
+			count += 1
+			if event.type == enet.EVENT_TYPE_CONNECT:
+				self.log('connected to server')
+				self.start_time = monotonic()
+				self.start_recording()
+			elif event.type == enet.EVENT_TYPE_DISCONNECT:
+				try:
+					reason = DISCONNECT_REASONS[event.data]
+				except IndexError:
+					reason = "unknown reason (%s)" % event.data
+				self.log('lost connection to server:', reason)
+				self.close()
+				self.reconnect_at = time() + args.reconnect_delay
+			elif event.type == enet.EVENT_TYPE_RECEIVE:
+				data = event.packet.data
+				self.recorder.write(monotonic() - self.start_time, data)
+				self.window_packets += 1
+				self.window_bytes += len(data)
+		if self.recorder is not None:
+			self.recorder.poll()
+		return count
+
+	def close(self):
+		if self.recorder is not None:
+			self.recorder.close()
+		self.host = self.peer = self.recorder = None
+		self.start_time = None
+
+	def update_rates(self, elapsed):
+		self.packet_rate = self.window_packets / elapsed
+		self.byte_rate = self.window_bytes / elapsed
+		self.packets += self.window_packets
+		self.bytes += self.window_bytes
+		self.window_packets = self.window_bytes = 0
+
+	def status(self):
+		return {
+			'name': self.name,
+			'address': '%s:%d' % (self.ip, self.port),
+			'connected': self.start_time is not None,
+			'file': self.recorder.path if self.recorder is not None else None,
+			'packets': self.packets + self.window_packets,
+			'bytes': self.bytes + self.window_bytes,
+			'packets_per_second': round(self.packet_rate, 2),
+			'bytes_per_second': round(self.byte_rate, 2),
+		}
+
+async def service_loop(recordings):
+	while True:
+		busy = 0
+		now = time()
+		for recording in recordings:
+			if recording.host is None:
+				if now >= recording.reconnect_at:
+					recording.connect()
+				continue
+			busy += recording.service()
+		# let other tasks run, but don't sleep while packets are arriving
+		await asyncio.sleep(0 if busy else args.poll_interval / 1000.)
+
+async def rate_loop(recordings):
+	last = time()
+	while True:
+		await asyncio.sleep(args.rate_interval)
+		now = time()
+		for recording in recordings:
+			recording.update_rates(now - last)
+			if recording.start_time is not None:
+				recording.log('%.1f packets/s, %.1f KiB/s' % (recording.packet_rate, recording.byte_rate / 1024.))
+		last = now
+
+async def main(recordings):
+	if args.status_port is not None:
+		async def send_status(reader, writer):
+			status = [recording.status() for recording in recordings]
+			writer.write(json.dumps(status).encode('utf-8') + b'\n')
+			await writer.drain()
+			writer.close()
+		await asyncio.start_server(send_status, '127.0.0.1', args.status_port)
+	await asyncio.gather(service_loop(recordings), rate_loop(recordings))
+
+recordings = []
+for spec in args.servers:
+	name, _, address = spec.partition('=')
+	if not name or not address:
+		print("ERROR: servers are given as NAME=ADDRESS, not %r" % spec)
+		sys.exit(1)
+	try:
+		ip, port = parse_address(address)
+	except DemoError:
+		print("ERROR: AoS address of %s not valid?" % name)
+		sys.exit(1)
+	recordings.append(ServerRecording(name, ip, port))
+
+os.makedirs(args.directory, exist_ok=True)
+try:
+	asyncio.run(main(recordings))
+except KeyboardInterrupt:
+	pass
+finally:
+	for recording in recordings:
+		recording.close()
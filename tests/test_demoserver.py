@@ -0,0 +1,107 @@
+"""
+Tests for the serving logic in scripts/demoserver.py. pyenet is replaced by
+a minimal stand-in when it isn't installed, nothing here touches the
+network.
+
+	python -m unittest discover tests
+"""
+
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+try:
+	import enet
+except ImportError:
+	enet = types.ModuleType('enet')
+	enet.EVENT_TYPE_NONE = 0
+	enet.EVENT_TYPE_CONNECT = 1
+	enet.EVENT_TYPE_DISCONNECT = 2
+	enet.EVENT_TYPE_RECEIVE = 3
+	enet.PACKET_FLAG_RELIABLE = 1
+	class Packet(object):
+		def __init__(self, data=b'', flags=0):
+			self.data = bytes(data)
+			self.flags = flags
+	enet.Packet = Packet
+	sys.modules['enet'] = enet
+
+import demoserver
+from aosdemo import (DemoReader, DemoWriter, MAP_START, MAP_CHUNK, STATE_DATA,
+	WORLD_UPDATE, INPUT_DATA, PLAYER_LEFT)
+
+class RecordingPeer(object):
+	def __init__(self):
+		self.packets = []
+	def send(self, channel, packet):
+		self.packets.append(packet.data)
+
+class Event(object):
+	def __init__(self, type):
+		self.type = type
+		self.peer = None
+		self.data = 0
+
+class IdleHost(object):
+	"""Has nothing pending, like an ENet host without traffic"""
+	def __init__(self):
+		self.calls = 0
+	def service(self, timeout):
+		self.calls += 1
+		if self.calls > 100:
+			raise AssertionError("service() kept polling an idle host")
+		return Event(enet.EVENT_TYPE_NONE)
+
+class RelayTest(unittest.TestCase):
+	def test_service_returns_on_idle_host(self):
+		host = IdleHost()
+		relay = demoserver.Relay(host, 3)
+		relay.service()
+		self.assertEqual(host.calls, 1)
+
+class PlaybackTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+	def write_demo(self, frames):
+		path = os.path.join(self.directory, 'test.demo')
+		with open(path, 'wb') as fh:
+			writer = DemoWriter(fh, 3)
+			for timestamp, data in frames:
+				writer.write(timestamp, data)
+			writer.close()
+		return DemoReader(path)
+
+	def test_coalesced_updates_go_before_player_left(self):
+		world_update = bytes([WORLD_UPDATE]) + bytes(24 * 32)
+		demo = self.write_demo([
+			(0.0, struct.pack('<BI', MAP_START, 1)),
+			(0.0, bytes([MAP_CHUNK, 0])),
+			(0.0, bytes([STATE_DATA]) + bytes(40)),
+			(1.0, world_update),
+			(1.0, bytes([INPUT_DATA, 1, 1])),
+			(1.0, bytes([PLAYER_LEFT, 1])),
+			(1.0, world_update),
+		])
+		scheduler = demoserver.Scheduler()
+		playback = demoserver.Playback(demo, scheduler, 0.0)
+		peer = RecordingPeer()
+		playback.attach(demoserver.Client(peer, scheduler, 3))
+		try:
+			playback.advance(now=10.0)
+		except EOFError:
+			pass
+		demo.close()
+		self.assertEqual([data[0] for data in peer.packets], [MAP_START,
+			MAP_CHUNK, STATE_DATA, WORLD_UPDATE, INPUT_DATA, PLAYER_LEFT,
+			WORLD_UPDATE])
+
+if __name__ == '__main__':
+	unittest.main()